@@ -0,0 +1,331 @@
+
+# Python 3 port of the two sqlite prototypes that benchmark.py compares against,
+# "class (fixed)" as QuadTree and "class (new faster)" as FasterQuadTree.
+# Only the classes are ported, without the debug prints and the __main__ scripts,
+# the sql and the behaviour are kept as they were, including the bugs of the faster one:
+# its split deletes links by oid rather than by nodeid and reads the node's items from the cursor it writes with,
+# and its intersect has no final boundscheck on the items
+
+import sqlite3
+import tempfile
+import os
+
+
+MAX_ITEMS = 10
+MAX_DEPTH = 20
+
+
+class QuadTree(object):
+    node_class = None # set below, once Node is defined
+
+    def __init__(self, xmin, ymin, xmax, ymax, max_items=MAX_ITEMS, max_depth=MAX_DEPTH):
+        # create db
+        self._addr = tempfile.mktemp()
+        self.db = sqlite3.connect(self._addr)
+        self.cur = self.db.cursor()
+
+        # params
+        self.max_items = max_items
+        self.max_depth = max_depth
+
+        # create node table
+        self.cur.execute('CREATE TABLE nodes (parent INT, depth INT, count INT, xmin REAL, ymin REAL, xmax REAL, ymax REAL)')
+        self.cur.execute('CREATE INDEX idx_nodes_parent ON nodes (parent)')
+
+        # create item table
+        self.cur.execute('CREATE TABLE items (item BLOB, xmin REAL, ymin REAL, xmax REAL, ymax REAL)')
+
+        # create link table
+        self.cur.execute('CREATE TABLE links (nodeid INT, itemid INT)')
+        self.cur.execute('CREATE INDEX idx_links ON links (nodeid, itemid)')
+
+        # create root node class
+        x,y = (xmin+xmax)/2.0, (ymin+ymax)/2.0
+        halfwidth = (xmax-xmin)/2.0
+        halfheight = (ymax-ymin)/2.0
+        parent = None
+        depth = 0
+        count = 0
+        self.root = self.node_class(self, None, parent, depth, count, x, y, halfwidth, halfheight)
+
+    def __del__(self):
+        os.remove(self._addr)
+
+    def __len__(self):
+        return self.count()
+
+    # Diagnostics
+
+    def count(self):
+        return self.cur.execute('SELECT Count(*) FROM (SELECT DISTINCT item FROM items)').fetchone()[0]
+
+    def depth(self):
+        return self.cur.execute('SELECT Max(depth) FROM nodes').fetchone()[0]
+
+    # Methods
+
+    def build(self, items):
+        for item,bbox in items:
+            # add item
+            xmin,ymin,xmax,ymax = bbox
+            self.cur.execute('INSERT INTO items VALUES (?, ?, ?, ?, ?)', (item, xmin, ymin, xmax, ymax) )
+            itemid = self.cur.lastrowid
+            # insert into tree
+            self.root.insert(itemid, bbox)
+
+    def intersect(self, bbox):
+        # query
+        x1,y1,x2,y2 = bbox
+        boundscheck = '({x1} < xmax AND {x2} > xmin) AND ({y1} < ymax AND {y2} > ymin)'.format(x1=x1, y1=y1, x2=x2, y2=y2)
+        res = self.cur.execute('''WITH traversal AS
+                          (SELECT oid, depth, CAST(oid AS text) AS path
+                           FROM nodes
+                           WHERE parent IS NULL AND {boundscheck}
+
+                           UNION ALL
+
+                           SELECT nodes.oid, nodes.depth, CAST(path || '.' || CAST(nodes.oid AS text) AS text) AS path
+                           FROM nodes
+                           INNER JOIN traversal
+                           ON traversal.oid = nodes.parent AND {boundscheck}
+                           )
+
+                           -- Extract
+                           SELECT items.oid, items.item, items.xmin, items.ymin, items.xmax, items.ymax, travitems.depth, travitems.path
+                           FROM items
+                           INNER JOIN (SELECT links.itemid,traversal.depth,traversal.path FROM links,traversal WHERE links.nodeid = traversal.oid) AS travitems ON items.oid = travitems.itemid
+                           WHERE {boundscheck}
+                        '''.format(boundscheck=boundscheck))
+        return res
+
+    def intersect_nodes(self, bbox):
+        # query
+        x1,y1,x2,y2 = bbox
+        boundscheck = '({x1} < xmax AND {x2} > xmin) AND ({y1} < ymax AND {y2} > ymin)'.format(x1=x1, y1=y1, x2=x2, y2=y2)
+        res = self.cur.execute('''WITH traversal AS
+                          (SELECT oid, depth, CAST(oid AS text) AS path
+                           FROM nodes
+                           WHERE parent IS NULL AND {boundscheck}
+
+                           UNION ALL
+
+                           SELECT nodes.oid, nodes.depth, CAST(path || '.' || CAST(nodes.oid AS text) AS text) AS path
+                           FROM nodes
+                           INNER JOIN traversal
+                           ON traversal.oid = nodes.parent AND {boundscheck}
+                           )
+
+                           -- Extract
+                           SELECT nodes.oid, nodes.xmin, nodes.ymin, nodes.xmax, nodes.ymax, nodes.count, traversal.depth, traversal.path
+                           FROM traversal INNER JOIN nodes ON traversal.oid = nodes.oid
+                        '''.format(boundscheck=boundscheck))
+        return res
+
+
+class Node(object):
+    def __init__(self, index, nodeid, parent=None, depth=None, count=None, x=None, y=None, halfwidth=None, halfheight=None):
+        self._index = index
+
+        if nodeid is None:
+            # nodeid doesnt exist, add it
+            xmin, ymin, xmax, ymax = x-halfwidth, y-halfheight, x+halfwidth, y+halfheight
+            self._index.cur.execute('INSERT INTO nodes VALUES (?, ?, ?, ?, ?, ?, ?)', (parent, depth, count, xmin, ymin, xmax, ymax) )
+            # set nodeid based on most recent insertion
+            nodeid = self._index.cur.lastrowid
+
+        else:
+            # retrieve existing node from table
+            parent, depth, count, xmin, ymin, xmax, ymax = self._index.cur.execute('SELECT * FROM nodes WHERE oid = ?', (nodeid,) ).fetchone()
+            x,y = (xmin+xmax)/2.0, (ymin+ymax)/2.0
+            halfwidth = (xmax-xmin)/2.0
+            halfheight = (ymax-ymin)/2.0
+
+        self.nodeid = nodeid
+        self.parent = parent
+        self.depth = depth
+        self.count = count
+        self.center = (x, y)
+        self.halfwidth = halfwidth
+        self.halfheight = halfheight
+
+    def subnodes(self):
+        return self._index.cur.execute('SELECT oid, * FROM nodes WHERE parent = ? ORDER BY ymin, xmin', (self.nodeid,) )
+
+    def items(self):
+        return self._index.cur.execute('SELECT items.oid, items.* FROM items INNER JOIN (SELECT itemid FROM links WHERE nodeid = ?) AS nodeitems ON items.oid = nodeitems.itemid', (self.nodeid,) )
+
+    def is_leaf(self):
+        subnodes = self._index.cur.execute('SELECT Count(*) FROM nodes WHERE parent = ?', (self.nodeid,) ).fetchone()[0]
+        if subnodes == 0:
+            return True
+
+    def insert(self, itemid, bbox):
+        # if is leaf node (has not yet been subdivided)
+        if self.is_leaf():
+            # link item to the node itself
+            self.link_item(itemid, bbox)
+
+            # test if should split
+            if self.count > self._index.max_items and self.depth < self._index.max_depth:
+                self.split()
+
+        # elif has subnodes
+        else:
+            # insert into each overlapping subnode
+            quads = self.quadrant(bbox)
+            subnodes = list(self.subnodes())
+            for quad in quads:
+                nodeid = subnodes[quad-1][0]
+                node = type(self)(self._index, nodeid)
+                node.insert(itemid, bbox)
+
+    def quadrant(self, bbox):
+        # test which quadrant the bbox belongs to
+        quads = []
+        if bbox[0] <= self.center[0]:
+            if bbox[1] <= self.center[1]:
+                quads.append(1)
+            if bbox[3] >= self.center[1]:
+                quads.append(3)
+        if bbox[2] > self.center[0]:
+            if bbox[1] <= self.center[1]:
+                quads.append(2)
+            if bbox[3] >= self.center[1]:
+                quads.append(4)
+        return quads
+
+    def create_subnodes(self):
+        halfwidth = self.halfwidth
+        halfheight = self.halfheight
+        quartwidth = halfwidth/2.0
+        quartheight = halfheight/2.0
+        x1 = self.center[0] - quartwidth
+        x2 = self.center[0] + quartwidth
+        y1 = self.center[1] - quartheight
+        y2 = self.center[1] + quartheight
+
+        # create 4 new subnodes
+        parent = self.nodeid
+        new_depth = self.depth + 1
+        count = 0
+        cls = type(self)
+        return [cls(self._index, None, parent, new_depth, count, x1, y1, quartwidth, quartheight),
+                cls(self._index, None, parent, new_depth, count, x2, y1, quartwidth, quartheight),
+                cls(self._index, None, parent, new_depth, count, x1, y2, quartwidth, quartheight),
+                cls(self._index, None, parent, new_depth, count, x2, y2, quartwidth, quartheight)]
+
+    def split(self):
+        subnodes = self.create_subnodes()
+
+        # delete previous links to this node and reset node count
+        items = list(self.items()) # get items before deleting the links
+        self._index.cur.execute('DELETE FROM links WHERE nodeid = ?', (self.nodeid,) )
+        self._index.cur.execute('UPDATE nodes SET count = 0 WHERE oid = ?', (self.nodeid,) )
+
+        # update items so they link to the new subnodes
+        for itemid,item,xmin,ymin,xmax,ymax in items:
+            bbox = xmin,ymin,xmax,ymax
+            quads = self.quadrant(bbox)
+            for quad in quads:
+                newnode = subnodes[quad-1]
+                # update count
+                self._index.cur.execute('UPDATE nodes SET count = count + 1 WHERE oid = ?', (newnode.nodeid,) )
+                newnode.count += 1
+                # add link
+                self._index.cur.execute('INSERT INTO links VALUES (?, ?)', (newnode.nodeid, itemid) )
+
+    def link_item(self, itemid, bbox):
+        # update count
+        self._index.cur.execute('UPDATE nodes SET count = count + 1 WHERE oid = ?', (self.nodeid,) )
+        self.count += 1
+        # add link
+        self._index.cur.execute('INSERT INTO links VALUES (?, ?)', (self.nodeid, itemid) )
+
+QuadTree.node_class = Node
+
+
+class FasterQuadTree(QuadTree):
+    # items are stored by the leaves they are inserted into, once per leaf
+
+    def build(self, items):
+        for item,bbox in items:
+            self.root.insert(item, bbox)
+
+    def intersect(self, bbox):
+        # query
+        x1,y1,x2,y2 = bbox
+        boundscheck = '({x1} < xmax AND {x2} > xmin) AND ({y1} < ymax AND {y2} > ymin)'.format(x1=x1, y1=y1, x2=x2, y2=y2)
+        res = self.cur.execute('''WITH traversal AS
+                          (SELECT oid, depth, CAST(oid AS text) AS path
+                           FROM nodes
+                           WHERE parent IS NULL AND {boundscheck}
+
+                           UNION ALL
+
+                           SELECT nodes.oid, nodes.depth, CAST(path || '.' || CAST(nodes.oid AS text) AS text) AS path
+                           FROM nodes
+                           INNER JOIN traversal
+                           ON traversal.oid = nodes.parent AND {boundscheck}
+                           )
+
+                           -- Extract
+                           SELECT items.oid, items.item, items.xmin, items.ymin, items.xmax, items.ymax, travitems.depth, travitems.path
+                           FROM items
+                           INNER JOIN (SELECT links.itemid,traversal.depth,traversal.path FROM links,traversal WHERE links.nodeid = traversal.oid) AS travitems ON items.oid = travitems.itemid
+                        '''.format(boundscheck=boundscheck))
+        return res
+
+
+class FasterNode(Node):
+
+    def insert(self, item, bbox):
+        # if is leaf node (has not yet been subdivided)
+        if self.is_leaf():
+            # add item on the node itself
+            self.add_item(item, bbox)
+
+            # test if should split
+            if self.count > self._index.max_items and self.depth < self._index.max_depth:
+                self.split()
+
+        # elif has subnodes
+        else:
+            # insert into each overlapping subnode
+            quads = self.quadrant(bbox)
+            subnodes = list(self.subnodes())
+            for quad in quads:
+                nodeid = subnodes[quad-1][0]
+                node = type(self)(self._index, nodeid)
+                node.insert(item, bbox)
+
+    def split(self):
+        subnodes = self.create_subnodes()
+
+        # update items so they link to the new subnodes
+        for itemid,item,xmin,ymin,xmax,ymax in self.items():
+            bbox = xmin,ymin,xmax,ymax
+            quads = self.quadrant(bbox)
+            for quad in quads:
+                newnode = subnodes[quad-1]
+                # update count
+                self._index.cur.execute('UPDATE nodes SET count = count + 1 WHERE oid = ?', (newnode.nodeid,) )
+                newnode.count += 1
+                # add link
+                self._index.cur.execute('INSERT INTO links VALUES (?, ?)', (newnode.nodeid, itemid) )
+
+        # delete previous links to this node and reset node count
+        self._index.cur.execute('DELETE FROM links WHERE oid = ?', (self.nodeid,) )
+        self._index.cur.execute('UPDATE nodes SET count = 0 WHERE oid = ?', (self.nodeid,) )
+
+    def add_item(self, item, bbox):
+        # add item
+        xmin,ymin,xmax,ymax = bbox
+        self._index.cur.execute('INSERT INTO items VALUES (?, ?, ?, ?, ?)', (item, xmin, ymin, xmax, ymax) )
+        itemid = self._index.cur.lastrowid
+        # update count
+        self._index.cur.execute('UPDATE nodes SET count = count + 1 WHERE oid = ?', (self.nodeid,) )
+        self.count += 1
+        # add link
+        self._index.cur.execute('INSERT INTO links VALUES (?, ?)', (self.nodeid, itemid) )
+
+FasterQuadTree.node_class = FasterNode
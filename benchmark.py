@@ -0,0 +1,813 @@
+import argparse
+import datetime
+import importlib.util
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+import tracemalloc
+
+from django.conf import settings
+import django
+
+
+def setup(database='sqlite'):
+    """
+    Configure a throwaway database for the djquadtree models.
+    """
+    if database == 'postgres':
+        databases = {
+            'default': {
+                'ENGINE': 'django.db.backends.postgresql',
+                'NAME': 'bench_db',
+                'HOST': '127.0.0.1',
+                'USER': 'postgres',
+                'PASSWORD': '',
+            }
+        }
+    else:
+        databases = {
+            'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': os.path.join(tempfile.mkdtemp(), 'bench.db'),
+            }
+        }
+    settings.configure(DATABASES=databases,
+                       INSTALLED_APPS=['djquadtree'],
+                       DEFAULT_AUTO_FIELD='django.db.models.AutoField')
+    django.setup()
+
+    from django.core.management import call_command
+    call_command('migrate', run_syncdb=True, verbosity=0)
+
+
+def random_items(n, seed=1, maxsize=1.0):
+    rand = random.Random(seed)
+    items = []
+    for i in range(n):
+        x = rand.uniform(-180, 180-maxsize)
+        y = rand.uniform(-90, 90-maxsize)
+        w = rand.uniform(0, maxsize)
+        h = rand.uniform(0, maxsize)
+        items.append((i, (x, y, x+w, y+h)))
+    return items
+
+def clustered_items(n, seed=1, clusters=5, spread=0.01, maxsize=0.0001, stacked=0.0):
+    # points and tiny boxes packed around a few centers, giving deep trees
+    # a stacked fraction of the items lies exactly on the centers
+    rand = random.Random(seed)
+    centers = [(rand.uniform(-170, 170), rand.uniform(-80, 80)) for _ in range(clusters)]
+    items = []
+    for i in range(n):
+        cx,cy = rand.choice(centers)
+        if rand.random() < stacked:
+            items.append((i, (cx, cy, cx, cy)))
+            continue
+        x = rand.gauss(cx, spread)
+        y = rand.gauss(cy, spread)
+        w = rand.uniform(0, maxsize)
+        h = rand.uniform(0, maxsize)
+        items.append((i, (x, y, x+w, y+h)))
+    return items
+
+def random_boxes(n, seed=2, size=5.0):
+    return [bbox for _,bbox in random_items(n, seed, size)]
+
+def build_tree(items, **kwargs):
+    from djquadtree.models import QuadTree
+    tree = QuadTree(xmin=-180, ymin=-90, xmax=180, ymax=90, **kwargs)
+    tree.save()
+    tree.build(items, bulk=True)
+    return tree
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    res = func(*args, **kwargs)
+    return time.time() - start, res
+
+def report(name, seconds, count):
+    print('{:<40} {:>10.1f} us/query {:>10.0f} queries/s'.format(name, seconds / count * 1e6, count / seconds))
+
+
+# Benchmarks
+
+def bench_intersect_sql(size, queries):
+    # parameterized intersect vs the old approach of formatting values into the sql text
+    from djquadtree.models import Item, INTERSECT_ALL_SQL, intersect_params
+    tree = build_tree(random_items(size))
+    boxes = random_boxes(queries)
+
+    def literal():
+        for bbox in boxes:
+            params = intersect_params(tree, bbox)
+            list(Item.objects.raw(INTERSECT_ALL_SQL % tuple(repr(p) for p in params)))
+
+    def parameterized():
+        for bbox in boxes:
+            list(tree.intersect(bbox, unique=False))
+
+    seconds,_ = timed(literal)
+    report('intersect, literal sql', seconds, queries)
+    seconds,_ = timed(parameterized)
+    report('intersect, parameterized sql', seconds, queries)
+
+def bench_intersect_many(size, queries):
+    # one intersect per bbox vs all bboxes in a single intersect_many
+    tree = build_tree(random_items(size))
+    boxes = random_boxes(256)
+    rounds = max(1, queries // len(boxes))
+
+    def single():
+        for _ in range(rounds):
+            for bbox in boxes:
+                list(tree.intersect(bbox))
+
+    def many():
+        for _ in range(rounds):
+            tree.intersect_many(boxes)
+
+    seconds,_ = timed(single)
+    report('256 bboxes, intersect each', seconds, rounds * len(boxes))
+    seconds,_ = timed(many)
+    report('256 bboxes, intersect_many', seconds, rounds * len(boxes))
+
+def bench_linear(size, queries):
+    # recursive cte traversal vs morton code range scans, on a deep clustered tree
+    from djquadtree.models import ENGINE_LINKS, ENGINE_LINEAR
+    items = clustered_items(size)
+    boxes = [(x-0.002, y-0.002, x+0.002, y+0.002) for _,(x,y,_,_) in clustered_items(queries, seed=3)]
+    for engine in (ENGINE_LINKS, ENGINE_LINEAR):
+        tree = build_tree(items, engine=engine)
+        depth = tree.depth()
+
+        def run():
+            for bbox in boxes:
+                list(tree.intersect(bbox))
+
+        seconds,_ = timed(run)
+        report('{} engine, depth {}'.format(engine, depth), seconds, queries)
+
+def bench_insert(size, queries):
+    # inserting into an existing tree by querying subnodes at every level, by descending a cached skeleton,
+    # and with node count updates buffered in an insert session
+    # each run is one transaction, so commits don't dominate the timings
+    from django.db import connection, transaction
+    from djquadtree.models import Item, Node
+    items = random_items(size)
+    extra = [(size+i, bbox) for i,(_,bbox) in enumerate(random_items(queries, seed=4))]
+
+    def legacy(tree):
+        with transaction.atomic():
+            for item_id,bbox in extra:
+                item = Item.objects.create(item_id=item_id, xmin=bbox[0], ymin=bbox[1], xmax=bbox[2], ymax=bbox[3])
+                Node.objects.get(pk=tree.root_id).insert(item)
+
+    def skeleton(tree):
+        with transaction.atomic():
+            for item_id,bbox in extra:
+                tree.insert(item_id, bbox)
+
+    def session(tree):
+        with tree.insert_session():
+            for item_id,bbox in extra:
+                tree.insert(item_id, bbox)
+
+    for name,func in [('Node.insert from root', legacy),
+                      ('QuadTree.insert via skeleton', skeleton),
+                      ('QuadTree.insert in insert_session', session)]:
+        tree = build_tree(items)
+        statements = []
+        def count(execute, sql, params, many, context):
+            statements.append(sql)
+            return execute(sql, params, many, context)
+        with connection.execute_wrapper(count):
+            seconds,_ = timed(func, tree)
+        report('insert, {}'.format(name), seconds, queries)
+        print('{:<40} {:>10.1f} statements/insert'.format('', len(statements) / float(queries)))
+
+def bench_single_insert(size, queries):
+    # QuadTree.insert calls that each commit on their own, without subtree counts as before they were kept,
+    # with the subtree_count of every ancestor updated as the insert descends, and held back by an insert session
+    import contextlib
+    from unittest import mock
+    from django.db import connection
+    from djquadtree import models
+    items = random_items(size)
+    extra = [(size+i, bbox) for i,(_,bbox) in enumerate(random_items(queries, seed=4))]
+
+    def insert(tree):
+        for item_id,bbox in extra:
+            tree.insert(item_id, bbox)
+
+    def nosession():
+        return mock.patch.object(models.QuadTree, 'insert_session', lambda self: contextlib.nullcontext())
+
+    def nocounts():
+        return mock.patch.object(models, 'add_owned', lambda treeid, nodeids: None)
+
+    for name,patches in [('no subtree counts', [nosession, nocounts]),
+                         ('counts per statement', [nosession]),
+                         ('counts in insert_session', [])]:
+        tree = build_tree(items)
+        statements = []
+        def count(execute, sql, params, many, context):
+            statements.append(sql)
+            return execute(sql, params, many, context)
+        with contextlib.ExitStack() as stack:
+            for patch in patches:
+                stack.enter_context(patch())
+            stack.enter_context(connection.execute_wrapper(count))
+            seconds,_ = timed(insert, tree)
+        report('single insert, {}'.format(name), seconds, queries)
+        print('{:<40} {:>10.1f} statements/insert'.format('', len(statements) / float(queries)))
+
+def bench_classify(size, queries):
+    # grouping the items of a splitting leaf by quadrant, per item vs vectorized
+    from djquadtree import models
+    for count in (10, 100, 1000, 10000):
+        items = [models.Item(item_id=i, xmin=b[0], ymin=b[1], xmax=b[2], ymax=b[3]) for i,b in random_items(count, maxsize=20)]
+        rounds = max(1, size // count)
+        for vectorized in (False, True):
+            if vectorized and models.numpy is None:
+                continue
+            minitems = models.VECTORIZE_MIN_ITEMS
+            models.VECTORIZE_MIN_ITEMS = 0 if vectorized else float('inf')
+            try:
+                seconds,_ = timed(lambda: [models.group_quadrants((0.0, 0.0), items) for _ in range(rounds)])
+            finally:
+                models.VECTORIZE_MIN_ITEMS = minitems
+            print('{:<40} {:>10.2f} us/item'.format('{} items, {}'.format(count, 'numpy' if vectorized else 'python'), seconds / (rounds * count) * 1e6))
+        if models.numpy is not None:
+            # bboxes already held in an array, as for packed leaves
+            bboxes = models.numpy.array([b for _,b in random_items(count, maxsize=20)])
+            seconds,_ = timed(lambda: [models.classify_quadrants((0.0, 0.0), bboxes) for _ in range(rounds)])
+            print('{:<40} {:>10.2f} us/item'.format('{} bbox array, numpy'.format(count), seconds / (rounds * count) * 1e6))
+
+def bench_multilevel(size, queries):
+    # large polygons linked into every overlapping leaf vs kept at the deepest node containing them
+    from djquadtree.models import ItemNodeLink
+    items = random_items(size, maxsize=10)
+    boxes = random_boxes(queries)
+    for multilevel in (False, True):
+        tree = build_tree(items, multilevel=multilevel)
+        links = ItemNodeLink.objects.filter(node__index=tree).count()
+
+        def run():
+            for bbox in boxes:
+                list(tree.intersect(bbox))
+
+        seconds,_ = timed(run)
+        report('multilevel={}, {} links'.format(multilevel, links), seconds, queries)
+
+def bench_unique(size, queries):
+    # deduplicating items that span several leaves, in python, with sql DISTINCT, and with the reference point rule
+    from djquadtree.models import Item, INTERSECT_ALL_SQL, intersect_params
+    tree = build_tree(random_items(size, maxsize=10), max_items=5)
+    boxes = random_boxes(queries, size=20)
+    rows = sum(len(list(tree.intersect(bbox, unique=False))) for bbox in boxes)
+    hits = sum(len(list(tree.intersect(bbox))) for bbox in boxes)
+    print('{:<40} {:>10.1f} rows/query {:>10.1f} items/query'.format('', rows / float(queries), hits / float(queries)))
+    distinct_sql = 'SELECT DISTINCT * FROM ({}) AS matches'.format(INTERSECT_ALL_SQL)
+
+    def python():
+        for bbox in boxes:
+            dict((item.pk, item) for item in tree.intersect(bbox, unique=False))
+
+    def distinct():
+        for bbox in boxes:
+            list(Item.objects.raw(distinct_sql, intersect_params(tree, bbox)))
+
+    def reference():
+        for bbox in boxes:
+            list(tree.intersect(bbox))
+
+    for name,func in [('dedupe in python', python), ('select distinct', distinct), ('reference point', reference)]:
+        seconds,_ = timed(func)
+        report('unique, {}'.format(name), seconds, queries)
+
+def bench_count(size, queries):
+    # counting the items in growing bboxes by fetching them vs with intersect_count
+    tree = build_tree(random_items(size))
+    for boxsize in (5.0, 40.0, 160.0):
+        boxes = random_boxes(queries, size=boxsize)
+
+        def fetch():
+            for bbox in boxes:
+                len(list(tree.intersect(bbox)))
+
+        def count():
+            for bbox in boxes:
+                tree.intersect_count(bbox)
+
+        for name,func in [('fetch', fetch), ('intersect_count', count)]:
+            seconds,_ = timed(func)
+            report('{:g} degree bboxes, {}'.format(boxsize, name), seconds, queries)
+
+def bench_zoom(size, queries):
+    # intersects from zoomed in to zoomed out, where most nodes are inside the bbox
+    from djquadtree.models import ENGINE_LINKS, ENGINE_PACKED
+    items = random_items(size)
+    for engine in (ENGINE_LINKS, ENGINE_PACKED):
+        tree = build_tree(items, engine=engine)
+        for boxsize in (5.0, 90.0, 340.0):
+            boxes = [(x-boxsize/2, y-boxsize/4, x+boxsize/2, y+boxsize/4)
+                     for x,y,_,_ in random_boxes(max(1, queries // 100), size=0)]
+
+            def run():
+                for bbox in boxes:
+                    list(tree.intersect(bbox))
+
+            seconds,_ = timed(run)
+            report('{} engine, {:g} degree bboxes'.format(engine, boxsize), seconds, len(boxes))
+
+def bench_nearest(size, queries):
+    # the 10 nearest items by best-first search vs intersecting a growing bbox until it holds them
+    from djquadtree.models import bbox_distance, item_bbox
+    tree = build_tree(random_items(size))
+    points = [(x, y) for x,y,_,_ in random_boxes(queries, size=0)]
+    k = 10
+
+    def grow():
+        for point in points:
+            x,y = point
+            radius = 1.0
+            while True:
+                items = list(tree.intersect((x-radius, y-radius, x+radius, y+radius)))
+                if len(items) >= k or radius > 360:
+                    break
+                radius *= 2
+            # the kth item in the square may not be the kth nearest, so query once more out to its distance
+            radius = sorted(bbox_distance(point, item_bbox(item)) for item in items)[:k][-1]
+            items = list(tree.intersect((x-radius, y-radius, x+radius, y+radius)))
+            sorted(items, key=lambda item: bbox_distance(point, item_bbox(item)))[:k]
+
+    def nearest():
+        for point in points:
+            tree.nearest(point, k)
+
+    for name,func in [('growing intersect', grow), ('best-first nearest', nearest)]:
+        seconds,_ = timed(func)
+        report('{} nearest, {}'.format(k, name), seconds, queries)
+
+def bench_point(size, queries):
+    # click lookups as a zero size intersect vs following the single path of the point
+    tree = build_tree(random_items(size))
+    points = [(x, y) for x,y,_,_ in random_boxes(queries, size=0)]
+    tree.intersect_point(0, 0) # load the skeleton
+
+    def bbox():
+        for x,y in points:
+            list(tree.intersect((x, y, x, y)))
+
+    def point():
+        for x,y in points:
+            tree.intersect_point(x, y)
+
+    for name,func in [('intersect((x,y,x,y))', bbox), ('intersect_point(x,y)', point)]:
+        seconds,_ = timed(func)
+        report('point, {}'.format(name), seconds, queries)
+
+def bench_join(size, queries):
+    # all overlapping (region, place) pairs by probing the places with each region vs a dual-tree join
+    regions = random_items(queries, seed=2, maxsize=10.0)
+    places = random_items(size)
+    regiontree = build_tree(regions)
+    placetree = build_tree(places)
+    placetree.intersect_point(0, 0) # load the skeletons
+    regiontree.intersect_point(0, 0)
+
+    def probe():
+        return [(i, item.item_id) for i,bbox in regions for item in placetree.intersect(bbox)]
+
+    def join():
+        return list(regiontree.join(placetree))
+
+    for name,func in [('intersect per region', probe), ('join', join)]:
+        seconds,pairs = timed(func)
+        report('join, {} ({} pairs)'.format(name, len(pairs)), seconds, queries)
+
+def bench_lookup(size, queries):
+    # the first page of a model filtered by a bbox, through a list of intersected ids vs the intersects lookup
+    # the item rows of one tree stand in for the model, indexed by a second tree using their pks as item ids
+    from djquadtree.models import Item
+    places = build_tree(random_items(size))
+    tree = build_tree([(item.pk, (item.xmin, item.ymin, item.xmax, item.ymax))
+                       for item in Item.objects.filter(links__node__index=places).distinct()])
+    boxes = random_boxes(queries, size=20)
+
+    def ids():
+        for bbox in boxes:
+            itemids = [item.item_id for item in tree.intersect(bbox)]
+            list(Item.objects.filter(pk__in=itemids, xmin__gt=0).order_by('xmin')[:20])
+
+    def lookup():
+        for bbox in boxes:
+            list(Item.objects.filter(pk__quadtree__intersects=(tree, bbox), xmin__gt=0).order_by('xmin')[:20])
+
+    for name,func in [('filter(pk__in=ids)', ids), ('quadtree__intersects', lookup)]:
+        seconds,_ = timed(func)
+        report('lookup, {}'.format(name), seconds, queries)
+
+def bench_binding(size, queries):
+    # importing model instances with one tree insert per save vs a binding that inserts them in one batch on commit
+    from django.db import connection, models, transaction
+    from djquadtree.models import QuadTree, QuadTreeBinding
+
+    class Place(models.Model):
+        xmin = models.FloatField(db_column='x_min')
+        ymin = models.FloatField()
+        xmax = models.FloatField(db_column='x_max')
+        ymax = models.FloatField()
+
+        class Meta:
+            app_label = 'djquadtree'
+
+    with connection.schema_editor() as editor:
+        editor.create_model(Place)
+    items = random_items(size)
+
+    def empty_tree():
+        tree = QuadTree(xmin=-180, ymin=-90, xmax=180, ymax=90)
+        tree.save()
+        return tree
+
+    def unindexed():
+        with transaction.atomic():
+            for _,bbox in items:
+                Place.objects.create(xmin=bbox[0], ymin=bbox[1], xmax=bbox[2], ymax=bbox[3])
+
+    def per_save():
+        tree = empty_tree()
+        tree.create_root()
+        with transaction.atomic():
+            for _,bbox in items:
+                place = Place.objects.create(xmin=bbox[0], ymin=bbox[1], xmax=bbox[2], ymax=bbox[3])
+                tree.insert(place.pk, bbox)
+
+    def binding(built):
+        tree = empty_tree()
+        if built:
+            tree.create_root()
+        binding = QuadTreeBinding(Place, tree)
+        with transaction.atomic():
+            for _,bbox in items:
+                Place.objects.create(xmin=bbox[0], ymin=bbox[1], xmax=bbox[2], ymax=bbox[3])
+        binding.disconnect()
+
+    for name,func in [('no index', unindexed),
+                      ('insert per save', per_save),
+                      ('binding, batched insert on commit', lambda: binding(True)),
+                      ('binding, bulk build on commit', lambda: binding(False))]:
+        seconds,_ = timed(func)
+        report('import, {}'.format(name), seconds, size)
+
+def bench_remove(size, queries):
+    # removing 90% of the items in batches, then querying the tree vs a fresh build of the remaining items
+    items = random_items(size)
+    kept,removed = items[::10], [item for i,item in enumerate(items) if i % 10]
+    boxes = random_boxes(queries)
+    tree = build_tree(items)
+    nodes = tree.nodes.count()
+
+    def remove():
+        for start in range(0, len(removed), 1000):
+            tree.remove_many(removed[start:start+1000])
+
+    seconds,_ = timed(remove)
+    report('remove_many, batches of 1000', seconds, len(removed))
+    print('{:<40} {:>10} nodes before {:>10} after'.format('remove_many', nodes, tree.nodes.count()))
+    fresh = build_tree(kept)
+    print('{:<40} {:>10} nodes'.format('fresh build', fresh.nodes.count()))
+
+    for name,tree in [('after removal', tree), ('fresh build', fresh)]:
+        def run():
+            for bbox in boxes:
+                list(tree.intersect(bbox))
+        seconds,_ = timed(run)
+        report('intersect, {}'.format(name), seconds, queries)
+
+def bench_compact(size, queries):
+    # querying an incrementally built tree after half its items were removed without merging, before and after compact()
+    from djquadtree.models import QuadTree
+    items = random_items(size)
+    boxes = random_boxes(queries)
+    tree = QuadTree(xmin=-180, ymin=-90, xmax=180, ymax=90)
+    tree.save()
+    tree.build(items)
+    tree.collapse = lambda skeleton, slots: 0
+    tree.remove_many(items[::2])
+    del tree.collapse
+
+    def run():
+        for bbox in boxes:
+            list(tree.intersect(bbox))
+
+    seconds,_ = timed(run)
+    report('intersect, degraded', seconds, queries)
+    seconds,res = timed(tree.compact)
+    print('{:<40} {:>10.2f} s {} -> {} nodes, {} -> {} links'.format('compact', seconds, res['nodes'][0], res['nodes'][1],
+                                                                   res['links'][0], res['links'][1]))
+    seconds,_ = timed(run)
+    report('intersect, compacted', seconds, queries)
+
+def bench_policy(size, queries):
+    # tree shape and query speed of the split policies on settlement-like data,
+    # dense clusters with some items stacked on the same spot, queried at city and regional scale
+    from djquadtree.models import SPLIT_POLICY_CHOICES
+    items = clustered_items(size, clusters=50, spread=0.05, stacked=0.05)
+    rand = random.Random(3)
+    points = [bbox for _,bbox in rand.sample(items, queries)]
+    cityboxes = [(x-0.01, y-0.01, x+0.01, y+0.01) for x,y,_,_ in points]
+    regionboxes = [(x-2.5, y-2.5, x+2.5, y+2.5) for x,y,_,_ in points]
+    for policy,_ in SPLIT_POLICY_CHOICES:
+        seconds,tree = timed(build_tree, items, split_policy=policy)
+        leaves = tree.nodes.filter(item_count__isnull=False)
+        print('{:<40} {:>10.2f} s build {:>6} nodes {:>3} depth {:>6} most items in a leaf'.format(
+            '{} policy'.format(policy), seconds, tree.nodes.count(), tree.depth(),
+            max(leaves.values_list('item_count', flat=True))))
+        for scale,boxes in [('city', cityboxes), ('region', regionboxes)]:
+            def run():
+                for bbox in boxes:
+                    list(tree.intersect(bbox))
+            seconds,_ = timed(run)
+            report('{} policy, {} intersect'.format(policy, scale), seconds, queries)
+
+def bench_grow(size, queries):
+    # a projected layer in meters, a 50 km region far from the origin,
+    # indexed with guessed world bounds vs a tree grown out from a 1 km box as items arrive
+    from djquadtree.models import QuadTree
+    rand = random.Random(1)
+    x0,y0 = 500000.0, 6600000.0
+    items = []
+    for i in range(size):
+        x,y = x0 + rand.uniform(0, 50000), y0 + rand.uniform(0, 50000)
+        items.append((i, (x, y, x + rand.uniform(0, 50), y + rand.uniform(0, 50))))
+    points = [bbox for _,bbox in rand.sample(items, queries)]
+    boxes = [(x-500, y-500, x+500, y+500) for x,y,_,_ in points]
+    def build(bounds, grow):
+        tree = QuadTree(xmin=bounds[0], ymin=bounds[1], xmax=bounds[2], ymax=bounds[3], grow=grow)
+        tree.save()
+        tree.build(items)
+        return tree
+    for name,bounds,grow in [('guessed', (-2e7, -2e7, 2e7, 2e7), False), ('grown', (x0, y0, x0 + 1000, y0 + 1000), True)]:
+        seconds,tree = timed(build, bounds, grow)
+        print('{:<40} {:>10.2f} s build {:>6} nodes {:>3} depth'.format(
+            '{} bounds'.format(name), seconds, tree.nodes.count(), tree.depth()))
+        def run():
+            for bbox in boxes:
+                list(tree.intersect(bbox))
+        seconds,_ = timed(run)
+        report('{} bounds, intersect'.format(name), seconds, queries)
+
+def bench_backend(size, queries):
+    # the work that goes through the backend layer, run with --db=sqlite and --db=postgres to compare
+    # bulk and streaming builds, batched queries, node item reads and a streamed whole-tree result
+    from djquadtree.models import QuadTree, backend
+    print('{:<40} {:>10}'.format('backend', type(backend()).__name__))
+    items = random_items(size)
+    boxes = random_boxes(queries)
+    seconds,tree = timed(build_tree, items)
+    report('bulk build', seconds, size)
+    def streamed():
+        tree = QuadTree(xmin=-180, ymin=-90, xmax=180, ymax=90)
+        tree.save()
+        tree.build(items, chunksize=5000)
+    seconds,_ = timed(streamed)
+    report('streaming build', seconds, size)
+    seconds,_ = timed(tree.intersect_many, boxes)
+    report('intersect_many', seconds, queries)
+    nodeids = list(tree.nodes.values_list('id', flat=True))
+    seconds,_ = timed(tree.node_item_rows, nodeids)
+    report('node_item_rows', seconds, len(nodeids))
+    world = (-180, -90, 180, 90)
+    seconds,_ = timed(lambda: list(tree.intersect(world)))
+    report('whole tree, intersect', seconds, size)
+    seconds,_ = timed(lambda: sum(1 for _ in tree.iter_intersect(world)))
+    report('whole tree, iter_intersect', seconds, size)
+
+def bench_rtree(size, queries):
+    # the node engines vs the sqlite R*Tree virtual table, on build time, file size and query latency
+    from django.db import connection
+    from djquadtree.models import ENGINE_LINKS, ENGINE_PACKED, ENGINE_RTREE
+    items = random_items(size)
+    boxes = random_boxes(queries)
+    smallboxes = random_boxes(queries, size=0.5)
+    for engine in (ENGINE_LINKS, ENGINE_PACKED, ENGINE_RTREE):
+        filesize = lambda: os.path.getsize(connection.settings_dict['NAME']) if connection.vendor == 'sqlite' else 0
+        before = filesize()
+        seconds,tree = timed(build_tree, items, engine=engine)
+        growth = (filesize() - before) / 1024.0
+        print('{:<40} {:>10.2f} s build {:>10.0f} kb'.format('{} engine'.format(engine), seconds, growth))
+        for name,bboxes in [('intersect', boxes), ('small intersect', smallboxes)]:
+            def run():
+                for bbox in bboxes:
+                    list(tree.intersect(bbox))
+            seconds,_ = timed(run)
+            report('{} engine, {}'.format(engine, name), seconds, queries)
+        def count():
+            for bbox in boxes:
+                tree.intersect_count(bbox)
+        seconds,_ = timed(count)
+        report('{} engine, intersect_count'.format(engine), seconds, queries)
+
+# Synthetic datasets of the suite, each seeded so every run indexes the same items
+SUITE_DATASETS = {
+    'uniform': lambda n, seed: random_items(n, seed),
+    'clustered': lambda n, seed: clustered_items(n, seed, clusters=20, spread=1.0, maxsize=0.1),
+    'polygons': lambda n, seed: random_items(n, seed, maxsize=30.0),
+    'points': lambda n, seed: random_items(n, seed, maxsize=0.0),
+}
+
+# the sqlite prototypes the django models grew out of, the (explore) files are python 2
+# so their classes are loaded from the python 3 port next to them
+PROTOTYPE_PORT = 'sqlite quadtree alg, class (py3 port).py'
+PROTOTYPES = [('prototype (fixed)', 'QuadTree'),
+              ('prototype (new faster)', 'FasterQuadTree'),
+              ]
+
+def load_prototype(filename=PROTOTYPE_PORT):
+    # the module of an (explore) prototype, or the reason it can't be loaded
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '(explore)', filename)
+    try:
+        spec = importlib.util.spec_from_file_location('prototype', path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    except (OSError, ImportError, SyntaxError) as err:
+        return '{}: {}'.format(type(err).__name__, err)
+    return module
+
+def suite_contenders():
+    # (name, build, skipped) triples, build(items) returns (intersect, batch, storage) functions
+    # storage gives the kb the index takes on disk, or None
+    from django.db import connection
+    from djquadtree.models import ENGINES, ENGINE_RTREE
+    contenders = []
+    for engine,_ in ENGINES:
+        if engine == ENGINE_RTREE and connection.vendor != 'sqlite':
+            contenders.append(('djquadtree ' + engine, None, 'needs sqlite'))
+            continue
+        def build(items, engine=engine):
+            tree = build_tree(items, engine=engine)
+            return (lambda bbox: list(tree.intersect(bbox)),
+                    lambda bboxes: tree.intersect_many(bboxes),
+                    None)
+        contenders.append(('djquadtree ' + engine, build, None))
+    module = load_prototype()
+    for name,classname in PROTOTYPES:
+        if isinstance(module, str):
+            contenders.append((name, None, module))
+            continue
+        def build(items, cls=getattr(module, classname)):
+            index = cls(-180, -90, 180, 90)
+            index.build(items)
+            def storage():
+                # the prototypes never commit, so their rows are only in the file after this
+                index.db.commit()
+                return os.path.getsize(index._addr) / 1024.0
+            return (lambda bbox: list(index.intersect(bbox)),
+                    lambda bboxes: [list(index.intersect(bbox)) for bbox in bboxes],
+                    storage)
+        contenders.append((name, build, None))
+    try:
+        import pyqtree
+    except ImportError as err:
+        contenders.append(('pyqtree', None, 'ImportError: {}'.format(err)))
+    else:
+        def build(items):
+            index = pyqtree.Index(bbox=[-180, -90, 180, 90])
+            for item,bbox in items:
+                index.insert(item, bbox)
+            return (lambda bbox: index.intersect(bbox),
+                    lambda bboxes: [index.intersect(bbox) for bbox in bboxes],
+                    None)
+        contenders.append(('pyqtree', build, None))
+    return contenders
+
+def bench_suite(size, queries, seed=1):
+    # every contender on every synthetic dataset, at a tenth of size and at size,
+    # timing the build, single intersects and one batch of all the query bboxes
+    # memory is the peak of python allocations during a second, traced build,
+    # storage is the growth of the sqlite file, or the prototype's own file
+    # returns the results for --json, contenders that can't run are listed with the reason
+    from django.db import connection
+    sizes = sorted(set([max(1, size // 10), size]))
+    boxes = random_boxes(queries, seed=seed + 1)
+    filesize = lambda: os.path.getsize(connection.settings_dict['NAME']) / 1024.0 if connection.vendor == 'sqlite' else None
+    contenders = suite_contenders()
+    results = []
+    for name,build,skipped in contenders:
+        if skipped:
+            print('{:<40} skipped, {}'.format(name, skipped))
+    for dataset in sorted(SUITE_DATASETS):
+        for n in sizes:
+            items = SUITE_DATASETS[dataset](n, seed)
+            for name,build,skipped in contenders:
+                if skipped:
+                    continue
+                before = filesize()
+                seconds,(intersect,batch,storage) = timed(build, items)
+                storage = storage() if storage else (filesize() - before if before is not None else None)
+                tracemalloc.start()
+                build(items)
+                peak = tracemalloc.get_traced_memory()[1] / 1024.0
+                tracemalloc.stop()
+                single,matches = timed(lambda: sum(len(intersect(bbox)) for bbox in boxes))
+                batched,_ = timed(batch, boxes)
+                results.append({'dataset': dataset,
+                                'size': n,
+                                'contender': name,
+                                'build_s': seconds,
+                                'intersect_us': single / queries * 1e6,
+                                'batch_intersect_us': batched / queries * 1e6,
+                                'peak_memory_kb': peak,
+                                'storage_kb': storage,
+                                'matches': matches,
+                                })
+                print('{:<40} {:>8.2f} s build {:>8.1f} us/query {:>8.1f} us/batched {:>8.0f} kb peak {:>8} matches'.format(
+                    '{} {} {}'.format(dataset, n, name), seconds, single / queries * 1e6, batched / queries * 1e6, peak, matches))
+    return {'meta': {'date': datetime.datetime.now().isoformat(),
+                     'python': platform.python_version(),
+                     'django': django.get_version(),
+                     'database': connection.vendor,
+                     'sizes': sizes,
+                     'queries': queries,
+                     'seed': seed,
+                     'skipped': dict((name, skipped) for name,_,skipped in contenders if skipped)},
+            'results': results}
+
+def bench_packed(size, queries):
+    # item-node link rows vs items packed into a binary payload per node
+    # storage is measured as the growth of the sqlite file during the build
+    from django.db import connection
+    from djquadtree.models import ENGINE_LINKS, ENGINE_PACKED
+    items = random_items(size)
+    boxes = random_boxes(queries)
+    for engine in (ENGINE_LINKS, ENGINE_PACKED):
+        filesize = lambda: os.path.getsize(connection.settings_dict['NAME']) if connection.vendor == 'sqlite' else 0
+        before = filesize()
+        seconds,tree = timed(build_tree, items, engine=engine)
+        growth = (filesize() - before) / 1024.0
+        print('{:<40} {:>10.2f} s build {:>10.0f} kb'.format('{} engine'.format(engine), seconds, growth))
+
+        def run():
+            for bbox in boxes:
+                list(tree.intersect(bbox))
+
+        seconds,_ = timed(run)
+        report('{} engine, intersect'.format(engine), seconds, queries)
+
+
+BENCHMARKS = {
+    'intersect_sql': bench_intersect_sql,
+    'intersect_many': bench_intersect_many,
+    'linear': bench_linear,
+    'insert': bench_insert,
+    'single_insert': bench_single_insert,
+    'classify': bench_classify,
+    'multilevel': bench_multilevel,
+    'packed': bench_packed,
+    'unique': bench_unique,
+    'count': bench_count,
+    'zoom': bench_zoom,
+    'nearest': bench_nearest,
+    'point': bench_point,
+    'join': bench_join,
+    'lookup': bench_lookup,
+    'binding': bench_binding,
+    'remove': bench_remove,
+    'compact': bench_compact,
+    'policy': bench_policy,
+    'grow': bench_grow,
+    'backend': bench_backend,
+    'rtree': bench_rtree,
+    'suite': bench_suite,
+}
+
+if __name__ == '__main__':
+    """
+    Example usage:
+        $ python benchmark.py intersect_sql --size=10000 --queries=1000 --db=sqlite
+        $ python benchmark.py suite --json=results.json
+    """
+    parser = argparse.ArgumentParser(
+        usage="[benchmarks] [--size=10000] [--queries=1000] [--db=sqlite] [--json=path]",
+        description="Run djquadtree benchmarks."
+    )
+    parser.add_argument('benchmarks', nargs='*', type=str, default=sorted(BENCHMARKS.keys()))
+    parser.add_argument('--size', nargs='?', type=int, default=10000)
+    parser.add_argument('--queries', nargs='?', type=int, default=1000)
+    parser.add_argument('--db', nargs='?', type=str, default='sqlite')
+    parser.add_argument('--json', nargs='?', type=str, default=None, help='write the results of benchmarks that return them to this file')
+    args = parser.parse_args()
+    setup(args.db)
+    results = {}
+    for name in args.benchmarks:
+        print(name)
+        result = BENCHMARKS[name](args.size, args.queries)
+        if result is not None:
+            results[name] = result
+    if args.json:
+        with open(args.json, 'w') as fobj:
+            json.dump(results, fobj, indent=2)
@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class DjquadtreeConfig(AppConfig):
     name = 'djquadtree'
+
+    def ready(self):
+        from django.db import models
+        from .models import QuadTreeItem
+        models.IntegerField.register_lookup(QuadTreeItem)
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from djquadtree.models import QuadTree, ENGINE_RTREE
+
+
+class Command(BaseCommand):
+    help = 'Compact quadtrees: delete unreachable nodes, merge underfull sibling leaves and rewrite the nodes in tree order.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('trees', nargs='*', type=int, help='ids of the trees to compact, all trees if none are given')
+        parser.add_argument('--chunk-size', type=int, default=500, help='nodes per transaction')
+
+    def handle(self, *args, **options):
+        trees = QuadTree.objects.order_by('pk')
+        if options['trees']:
+            trees = trees.filter(pk__in=options['trees'])
+        for tree in trees:
+            if tree.engine == ENGINE_RTREE:
+                # the virtual table has no nodes to compact
+                self.stdout.write('tree {}: skipped, rtree engine trees have no nodes'.format(tree.pk))
+                continue
+            report = tree.compact(options['chunk_size'])
+            self.stdout.write('tree {}: nodes {} -> {}, links {} -> {}, {} unreachable nodes deleted, {} branches merged'.format(
+                tree.pk, report['nodes'][0], report['nodes'][1], report['links'][0], report['links'][1],
+                report['unreachable'], report['merged']))
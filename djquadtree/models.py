@@ -1,13 +1,69 @@
 from django.db import models
-from itertools import islice
+from django.db.models import Max, F, Q
+from itertools import islice, chain
+from operator import attrgetter
+from array import array
+import heapq
+import math
+import struct
+import sys
+import threading
+import time
+import uuid
 
-from django.db import connection
+from django.db import connection, transaction, OperationalError
+from django.db.models import signals
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+else:
+    PAYLOAD_DTYPE = numpy.dtype([('pk', '<i8'), ('item_id', '<i8'),
+                                 ('xmin', '<f8'), ('ymin', '<f8'), ('xmax', '<f8'), ('ymax', '<f8')])
 
 # Create your models here.
 
 DEBUG = False
 MAX_ITEMS = 10
 MAX_DEPTH = 20
+BULK_BATCH_SIZE = 10000
+IN_BATCH_SIZE = 500 # ids per IN (...) list
+UNNEST_BATCH_SIZE = 50000 # rows per array insert on postgresql
+STREAM_CHUNK_SIZE = 2000 # rows fetched at a time from a streaming cursor
+
+# storage engines
+ENGINE_LINKS = 'links'
+ENGINE_LINEAR = 'linear'
+ENGINE_PACKED = 'packed'
+ENGINE_RTREE = 'rtree'
+ENGINES = [(ENGINE_LINKS, 'Node tree with item links'),
+           (ENGINE_LINEAR, 'Linear quadtree with morton coded nodes'),
+           (ENGINE_PACKED, 'Node tree with packed item arrays in the nodes'),
+           (ENGINE_RTREE, 'SQLite R*Tree virtual table of the item bboxes, without nodes'),
+           ]
+
+# split policies, deciding when a full leaf is split, see SplitPolicy
+SPLIT_CENTER = 'center'
+SPLIT_GROWING = 'growing'
+SPLIT_SEPARATING = 'separating'
+SPLIT_POLICY_CHOICES = [(SPLIT_CENTER, 'Split leaves holding more than max_items'),
+                        (SPLIT_GROWING, 'Leaf capacity doubling every few levels'),
+                        (SPLIT_SEPARATING, 'Only split leaves if that separates their items'),
+                        ]
+GROWING_LEVELS = 4 # levels per doubling of the leaf capacity
+
+# linear quadtree codes: morton prefix at LINEAR_LEVELS resolution, followed by the node depth
+LINEAR_LEVELS = 28
+LINEAR_DEPTH_BITS = 5
+LINEAR_MAX_CELLS = 16
+
+# packed node payloads: item pk, item id and bbox of each item, little-endian
+PAYLOAD_FORMAT = '<qq4d'
+PAYLOAD_SIZE = struct.calcsize(PAYLOAD_FORMAT)
+
+# below this many items, classifying quadrants with numpy costs more than it saves
+VECTORIZE_MIN_ITEMS = 256
 
 # OPTIMIZATIONS
 # X implement own link model instead of a manytomanyfield (Item.nodes), since .add() seems to be very slow
@@ -20,105 +76,1443 @@ MAX_DEPTH = 20
 # - MAYBE, allow items to be stored at any level, eg if they span multiple quads (ie items belong to only one node, no need for slow links)...
 # - MAYBE, do everything with .raw() sql calls
 
+def iterchunks(items, chunksize):
+    # yield successive lists of at most chunksize items from any iterable
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, chunksize))
+        if not chunk:
+            break
+        yield chunk
+
+def interleave(ix, iy):
+    # morton (z-order) code of a cell, with x in the lower bit of each quadrant digit
+    code = 0
+    bit = 0
+    while ix or iy:
+        code |= ((ix & 1) << (2*bit)) | ((iy & 1) << (2*bit+1))
+        ix >>= 1
+        iy >>= 1
+        bit += 1
+    return code
+
+def quadrants(center, bbox):
+    # test which quadrant(s) of a node with the given center a bbox belongs to
+    quads = []
+    if bbox[0] <= center[0]:
+        if bbox[1] <= center[1]:
+            quads.append(1)
+        if bbox[3] >= center[1]:
+            quads.append(3)
+    if bbox[2] > center[0]:
+        if bbox[1] <= center[1]:
+            quads.append(2)
+        if bbox[3] >= center[1]:
+            quads.append(4)
+    return quads
+
+def owns_corner(bounds, treebounds, bbox):
+    # whether a node owns the lower left corner of a bbox, with the same half-open rules as quadrants(),
+    # nodes on the edges of the tree also own everything beyond them
+    xmin,ymin,xmax,ymax = bounds
+    txmin,tymin,txmax,tymax = treebounds
+    x,y = bbox[0],bbox[1]
+    return ((x > xmin or xmin <= txmin) and (x <= xmax or xmax >= txmax)
+            and (y >= ymin or ymin <= tymin) and (y < ymax or ymax >= tymax))
+
+def owns_reference(bounds, treebounds, bbox, itembox):
+    # python version of REFCHECK for a leaf, whether it reports an item found by a bbox query
+    xmin,ymin,xmax,ymax = bounds
+    txmin,tymin,txmax,tymax = treebounds
+    qx,qy = bbox[0],bbox[1]
+    ix,iy = itembox[0],itembox[1]
+    if ix > qx:
+        xok = (ix > xmin or xmin <= txmin) and (ix <= xmax or xmax >= txmax)
+    else:
+        xok = qx >= xmin or xmin <= txmin
+    yok = (iy >= ymin or qy >= ymin or ymin <= tymin) and (iy < ymax or ymax >= tymax)
+    return xok and yok
+
+def bbox_distance(point, bbox):
+    # euclidean distance from a point to the nearest point of a bbox, 0 inside it
+    x,y = point
+    dx = max(bbox[0] - x, 0, x - bbox[2])
+    dy = max(bbox[1] - y, 0, y - bbox[3])
+    return math.hypot(dx, dy)
+
+def edge_bounds(bounds, treebounds):
+    # the region a node may hold items in, nodes on the edges of the tree also hold items beyond them
+    xmin,ymin,xmax,ymax = bounds
+    txmin,tymin,txmax,tymax = treebounds
+    inf = float('inf')
+    return (-inf if xmin <= txmin else xmin, -inf if ymin <= tymin else ymin,
+            inf if xmax >= txmax else xmax, inf if ymax >= tymax else ymax)
+
+def node_distance(point, bounds, treebounds):
+    # lower bound on the distance from a point to the items of a node
+    return bbox_distance(point, edge_bounds(bounds, treebounds))
+
+def grown_bounds(bounds, bbox):
+    # the bounds doubled towards a bbox outside them, and the quadrant (1-4) the old bounds are in the new ones
+    xmin,ymin,xmax,ymax = bounds
+    width,height = xmax - xmin, ymax - ymin
+    left = bbox[0] < xmin
+    low = bbox[1] < ymin
+    grown = (xmin - width if left else xmin, ymin - height if low else ymin,
+             xmax if left else xmax + width, ymax if low else ymax + height)
+    return grown, (2 if left else 1) + (2 if low else 0)
+
+def bounds_meet(a, b):
+    # whether two bboxes overlap or touch
+    return a[0] <= b[2] and a[2] >= b[0] and a[1] <= b[3] and a[3] >= b[1]
+
+def partition_spanning(center, items):
+    # split Item instances into those that fit in a single quadrant and those spanning several
+    fitting = []
+    spanning = []
+    for item in items:
+        bbox = item.xmin,item.ymin,item.xmax,item.ymax
+        if len(quadrants(center, bbox)) > 1:
+            spanning.append(item)
+        else:
+            fitting.append(item)
+    return fitting, spanning
+
+def classify_quadrants(center, bboxes):
+    # vectorized quadrants() for a sequence or (N,4) array of bboxes
+    # returns the membership masks of quadrants 1-4, as numpy arrays if available, else lists
+    cx,cy = center
+    if numpy is not None:
+        bboxes = numpy.asarray(bboxes, dtype=float).reshape(-1, 4)
+        left = bboxes[:,0] <= cx
+        right = bboxes[:,2] > cx
+        low = bboxes[:,1] <= cy
+        high = bboxes[:,3] >= cy
+        return [left & low, right & low, left & high, right & high]
+    left = [bbox[0] <= cx for bbox in bboxes]
+    right = [bbox[2] > cx for bbox in bboxes]
+    low = [bbox[1] <= cy for bbox in bboxes]
+    high = [bbox[3] >= cy for bbox in bboxes]
+    return [[l and b for l,b in zip(left, low)],
+            [r and b for r,b in zip(right, low)],
+            [l and h for l,h in zip(left, high)],
+            [r and h for r,h in zip(right, high)]]
+
+item_bbox = attrgetter('xmin', 'ymin', 'xmax', 'ymax')
+
+def group_quadrants(center, items):
+    # group Item instances by the quadrants (1-4) they belong to, keeping their order
+    if numpy is None or len(items) < VECTORIZE_MIN_ITEMS:
+        grouped = {1:[], 2:[], 3:[], 4:[]}
+        for item in items:
+            bbox = item.xmin,item.ymin,item.xmax,item.ymax
+            for quad in quadrants(center, bbox):
+                grouped[quad].append(item)
+        return grouped
+    bboxes = numpy.fromiter(chain.from_iterable(map(item_bbox, items)), dtype=float, count=len(items)*4)
+    masks = classify_quadrants(center, bboxes)
+    items = numpy.array(items, dtype=object)
+    return dict((quad, items[mask].tolist())
+                for quad,mask in zip((1,2,3,4), masks))
+
+class SplitPolicy(object):
+    # when a leaf splits: holding more than max_items, above max_depth
+    # subclasses change the capacity per depth or veto splits, and are chosen per tree by their name in SPLIT_POLICIES
+    # leaves are always cut at their center, which the quadrant rules, the skeleton and the linear codes all rely on
+
+    def capacity(self, tree, depth):
+        # the number of items a leaf at this depth holds before it splits
+        return tree.max_items
+
+    def should_split(self, tree, node, count, bboxes):
+        # whether a leaf that just got its count-th item splits,
+        # bboxes is a callable returning the bboxes of the leaf's items, for policies that need to look at them
+        return count > self.capacity(tree, node.depth) and node.depth < tree.max_depth
+
+    def should_merge(self, tree, depth, count, bboxes):
+        # whether four sibling leaves holding count distinct items merge back into their parent at depth,
+        # the split rule in reverse, so that removals leave the tree as a fresh build of the remaining items would be
+        return count <= self.capacity(tree, depth)
+
+class GrowingSplitPolicy(SplitPolicy):
+    # the capacity doubles every GROWING_LEVELS levels, so dense clusters stop splitting at a shallower depth
+
+    def capacity(self, tree, depth):
+        return tree.max_items << (depth // GROWING_LEVELS)
+
+class SeparatingSplitPolicy(SplitPolicy):
+    # a full leaf only splits if some split, at any depth, can still separate its items, that is if their bboxes share no common point,
+    # so stacks of identical items stay in one leaf instead of making a chain of empty quadrants down to max_depth
+    # the check looks at all items, so a leaf that stays unsplit is only checked again after another capacity items
+
+    def should_split(self, tree, node, count, bboxes):
+        capacity = self.capacity(tree, node.depth)
+        if count <= capacity or node.depth >= tree.max_depth:
+            return False
+        if (count - 1) % capacity:
+            return False
+        return separable(bboxes())
+
+    def should_merge(self, tree, depth, count, bboxes):
+        # items that no split can separate merge whatever their count, a fresh build never splits them
+        # separable items over capacity stay split, although a fresh build may have left them unsplit between two checks
+        return count <= self.capacity(tree, depth) or not separable(bboxes())
+
+def separable(bboxes):
+    # whether the bboxes share no common point
+    xmins,ymins,xmaxs,ymaxs = zip(*bboxes)
+    return max(xmins) > min(xmaxs) or max(ymins) > min(ymaxs)
+
+SPLIT_POLICIES = {SPLIT_CENTER: SplitPolicy(),
+                  SPLIT_GROWING: GrowingSplitPolicy(),
+                  SPLIT_SEPARATING: SeparatingSplitPolicy(),
+                  }
+
+def pack_payload(items):
+    return b''.join(struct.pack(PAYLOAD_FORMAT, item.pk, item.item_id, item.xmin, item.ymin, item.xmax, item.ymax)
+                    for item in items)
+
+def payload_array(payload):
+    # view a packed payload as a numpy record array
+    return numpy.frombuffer(payload, dtype=PAYLOAD_DTYPE)
+
+def payload_bboxes(entries):
+    # (N,4) bbox array of payload records
+    return numpy.column_stack([entries['xmin'], entries['ymin'], entries['xmax'], entries['ymax']])
+
+def unpack_payload(payload):
+    # the items of a packed payload as (unsaved) Item instances
+    return [Item(id=pk, item_id=item_id, xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax)
+            for pk,item_id,xmin,ymin,xmax,ymax in struct_iter(PAYLOAD_FORMAT, payload)]
+
+def struct_iter(fmt, data):
+    size = struct.calcsize(fmt)
+    for offset in range(0, len(data), size):
+        yield struct.unpack_from(fmt, data, offset)
+
+def split_payload(center, payload, multilevel=False):
+    # divide a packed payload between the four quadrants of a node,
+    # returns the payload that stays on the node (spanning items of multilevel trees) and those of quadrants 1-4
+    if numpy is None:
+        items = unpack_payload(payload)
+        stay = []
+        if multilevel:
+            items,stay = partition_spanning(center, items)
+        grouped = group_quadrants(center, items)
+        return pack_payload(stay), [pack_payload(grouped[quad]) for quad in (1,2,3,4)]
+    entries = payload_array(payload)
+    masks = classify_quadrants(center, payload_bboxes(entries))
+    stay = numpy.zeros(len(entries), dtype=bool)
+    if multilevel:
+        stay = sum(mask.astype(int) for mask in masks) > 1
+        masks = [mask & ~stay for mask in masks]
+    return entries[stay].tobytes(), [entries[mask].tobytes() for mask in masks]
+
+def filter_payload(payload, bbox):
+    # the items of a packed payload that intersect the bbox, as (unsaved) Item instances
+    # a bbox of None returns all items
+    if numpy is None:
+        items = unpack_payload(payload)
+        if bbox is None:
+            return items
+        x1,y1,x2,y2 = bbox
+        return [item for item in items
+                if x1 < item.xmax and x2 > item.xmin and y1 < item.ymax and y2 > item.ymin]
+    entries = payload_array(payload)
+    if bbox is not None:
+        x1,y1,x2,y2 = bbox
+        entries = entries[(x1 < entries['xmax']) & (x2 > entries['xmin']) & (y1 < entries['ymax']) & (y2 > entries['ymin'])]
+    return [Item(id=pk, item_id=item_id, xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax)
+            for pk,item_id,xmin,ymin,xmax,ymax in entries.tolist()]
+
+def add_owned(treeid, nodeids):
+    # one more item owned by the subtree of each node
+    session = active_session(treeid)
+    if session is not None:
+        session.own(nodeids)
+    else:
+        connection.cursor().executemany(ADD_SUBTREE_SQL, [(1, nodeid) for nodeid in nodeids])
+
+def bump_version(treeid, current=None):
+    # write a new version token for a tree whose node structure changed, skeletons cached with the old one are then reloaded
+    # tokens are random rather than counted up, so a version rolled back along with its changes is never written again
+    # a skeleton kept in step with the change passes its version, and gets the new token back if the tree was still at it
+    token = uuid.uuid4().hex
+    cursor = connection.cursor()
+    if current is not None:
+        cursor.execute(SWAP_VERSION_SQL, [token, treeid, current])
+        if cursor.rowcount == 1:
+            return token
+    cursor.execute(BUMP_VERSION_SQL, [token, treeid])
+    return None
+
+def bulk_create_with_pks(model, objs):
+    # bulk insert objs so that their new primary keys are set afterwards
+    # backends that cannot return pks from a bulk insert fall back to one insert per object
+    features = connection.features
+    if getattr(features, 'can_return_rows_from_bulk_insert', False) or getattr(features, 'can_return_ids_from_bulk_insert', False):
+        model.objects.bulk_create(objs, batch_size=BULK_BATCH_SIZE)
+    else:
+        for obj in objs:
+            obj.save(force_insert=True)
+
+class Backend(object):
+    # the bulk work of a tree done in a way every database supports, see backend()
+
+    def bulk_insert(self, model, objs, pks=True):
+        # insert objs, setting their new primary keys unless pks is False
+        if pks:
+            bulk_create_with_pks(model, objs)
+        else:
+            model.objects.bulk_create(objs, batch_size=BULK_BATCH_SIZE)
+
+    def query_chunks(self, bboxes, extra=0):
+        # (offset, chunk, count, params) for intersecting bboxes with intersect_many_sql(count, ...),
+        # split over several statements only if they and the extra parameters of the statement exceed the parameter limit
+        maxparams = connection.features.max_query_params
+        chunksize = max(1, (maxparams - extra) // 4) if maxparams else max(1, len(bboxes))
+        for offset in range(0, len(bboxes), chunksize):
+            chunk = bboxes[offset:offset+chunksize]
+            params = []
+            for bbox in chunk:
+                params.extend(bbox)
+            yield offset, chunk, len(chunk), params
+
+    def add_count(self, nodeid, delta):
+        # add to the item_count of a node, returns the new count, including what other processes added
+        cursor = connection.cursor()
+        cursor.execute(ADD_COUNT_SQL, [delta, nodeid])
+        cursor.execute(GETCOUNT_SQL, [nodeid])
+        return cursor.fetchone()[0]
+
+    def read_count(self, nodeid):
+        # the item_count of a node, for an insert session to count on from
+        cursor = connection.cursor()
+        cursor.execute(GETCOUNT_SQL, [nodeid])
+        return cursor.fetchone()[0]
+
+    def append_payload(self, nodeid, payload):
+        # append packed items to a node's payload, and count them if it is a leaf, returns the new count
+        cursor = connection.cursor()
+        cursor.execute(APPEND_PAYLOAD_SQL, [payload, len(payload) // PAYLOAD_SIZE, nodeid])
+        cursor.execute(GETCOUNT_SQL, [nodeid])
+        return cursor.fetchone()[0]
+
+    def node_rows(self, cursor, nodeids, packed=False):
+        # the rows of node_items_sql for some nodes, IN_BATCH_SIZE nodes per statement
+        for start in range(0, len(nodeids), IN_BATCH_SIZE):
+            chunk = nodeids[start:start+IN_BATCH_SIZE]
+            cursor.execute(node_items_sql(len(chunk), packed), chunk)
+            for row in cursor.fetchall():
+                yield row
+
+    def stream_cursor(self):
+        # a cursor for results too large to fetch at once
+        return connection.cursor()
+
+class PostgresBackend(Backend):
+    # rows are inserted as one array per column, id lists and query bboxes are passed as arrays
+    # so each statement has a single shape whatever the count, and large results come from a server-side cursor
+
+    def bulk_insert(self, model, objs, pks=True):
+        pk = model._meta.pk
+        fields = [field for field in model._meta.concrete_fields if field is not pk]
+        columns = [field.column for field in fields]
+        types = [field.db_type(connection) for field in fields]
+        if pks:
+            columns.insert(0, pk.column)
+            types.insert(0, pk.rel_db_type(connection))
+        sql = POSTGRES_INSERT_SQL.format(table=model._meta.db_table,
+                                         columns=', '.join(columns),
+                                         arrays=', '.join('%s::{}[]'.format(t) for t in types))
+        cursor = connection.cursor()
+        for start in range(0, len(objs), UNNEST_BATCH_SIZE):
+            chunk = objs[start:start+UNNEST_BATCH_SIZE]
+            arrays = [[field.get_db_prep_save(field.pre_save(obj, True), connection) for obj in chunk]
+                      for field in fields]
+            if pks:
+                # reserve the ids up front, rather than rely on the order of returned rows
+                cursor.execute(POSTGRES_NEXTVAL_SQL, [model._meta.db_table, pk.column, len(chunk)])
+                ids = [row[0] for row in cursor.fetchall()]
+                for obj,objid in zip(chunk, ids):
+                    obj.pk = objid
+                arrays.insert(0, ids)
+            cursor.execute(sql, arrays)
+            for obj in chunk:
+                obj._state.adding = False
+                obj._state.db = connection.alias
+        # a table that has at least doubled is analyzed right away, rather than when autovacuum gets to it,
+        # with the old statistics the planner joins the items of a node by scanning the whole table
+        cursor.execute(POSTGRES_RELTUPLES_SQL, [model._meta.db_table])
+        if len(objs) > cursor.fetchone()[0]:
+            cursor.execute(POSTGRES_ANALYZE_SQL.format(table=connection.ops.quote_name(model._meta.db_table)))
+
+    def add_count(self, nodeid, delta):
+        cursor = connection.cursor()
+        cursor.execute(POSTGRES_ADD_COUNT_SQL, [delta, nodeid])
+        return cursor.fetchone()[0]
+
+    def read_count(self, nodeid):
+        # the row stays locked until the session commits, so concurrent sessions count on from each other's totals
+        cursor = connection.cursor()
+        cursor.execute(POSTGRES_READ_COUNT_SQL, [nodeid])
+        return cursor.fetchone()[0]
+
+    def append_payload(self, nodeid, payload):
+        cursor = connection.cursor()
+        cursor.execute(POSTGRES_APPEND_PAYLOAD_SQL, [payload, len(payload) // PAYLOAD_SIZE, nodeid])
+        return cursor.fetchone()[0]
+
+    def query_chunks(self, bboxes, extra=0):
+        if bboxes:
+            yield 0, bboxes, None, [list(coords) for coords in zip(*bboxes)]
+
+    def node_rows(self, cursor, nodeids, packed=False):
+        cursor.execute(node_items_sql(None, packed), [list(nodeids)])
+        return cursor.fetchall()
+
+    def stream_cursor(self):
+        # a named cursor, unless server-side cursors are disabled in the database settings
+        return connection.chunked_cursor()
+
+BACKENDS = {
+    'postgresql': PostgresBackend(),
+}
+
+def backend():
+    # the fast paths for the database in use, or the generic ones
+    return BACKENDS.get(connection.vendor) or GENERIC_BACKEND
+
+GENERIC_BACKEND = Backend()
+
 class QuadTree(models.Model):
-    xmin = models.FloatField()
+    xmin = models.FloatField(db_column='x_min') # xmin and xmax are system columns in postgresql
     ymin = models.FloatField()
-    xmax = models.FloatField()
+    xmax = models.FloatField(db_column='x_max')
     ymax = models.FloatField()
     max_items = models.IntegerField(default=MAX_ITEMS)
     max_depth = models.IntegerField(default=MAX_DEPTH)
     root = models.ForeignKey('Node', on_delete=models.CASCADE, db_index=True, null=True)
+    engine = models.CharField(max_length=20, choices=ENGINES, default=ENGINE_LINKS)
+    version = models.CharField(max_length=32, default='') # token replaced whenever the node structure changes, see bump_version
+    multilevel = models.BooleanField(default=False) # keep items at the deepest node that fully contains them
+    split_policy = models.CharField(max_length=20, choices=SPLIT_POLICY_CHOICES, default=SPLIT_CENTER)
+    grow = models.BooleanField(default=False) # grow a new root around the tree for items outside its bounds, see grow_to
+
+    def policy(self):
+        return SPLIT_POLICIES[self.split_policy]
+
+    def root_code(self):
+        # only linear trees give their nodes codes, which then propagate down from the root
+        if self.engine == ENGINE_LINEAR:
+            if self.grow:
+                raise ValueError('Linear quadtrees can not grow, their node codes are fixed to the tree bounds')
+            if self.max_depth > LINEAR_LEVELS:
+                raise ValueError('Linear quadtrees can have a max_depth of at most {}'.format(LINEAR_LEVELS))
+            return 0
+        return None
 
     def create_root(self):
-        root = Node.objects.create(index=self, depth=0, item_count=0, xmin=self.xmin, ymin=self.ymin, xmax=self.xmax, ymax=self.ymax)
+        if self.engine == ENGINE_RTREE:
+            self.create_rtree()
+            return
+        root = Node.objects.create(index=self, depth=0, item_count=0, code=self.root_code(), xmin=self.xmin, ymin=self.ymin, xmax=self.xmax, ymax=self.ymax)
         self.root = root
+        self.save(update_fields=['root'])
+        # skeletons cached before the tree had this root are of the old nodes, or empty
+        bump_version(self.pk)
+        self.forget_skeleton()
 
 ##    def count(self):
 ##        return self.nodes...
 ##        return self.cur.execute('SELECT Count(*) FROM (SELECT DISTINCT item FROM items)').fetchone()[0]
 
+    def check_nodes(self, operation):
+        # rtree trees keep their index in the virtual table, operations walking the nodes do not apply
+        if self.engine == ENGINE_RTREE:
+            raise ValueError('{} needs a node tree, rtree engine trees have none'.format(operation))
+
     def depth(self):
-        return self.nodes.all().aggregate(Max('depth'))
+        return self.nodes.all().aggregate(Max('depth'))['depth__max']
+
+    def bounds(self):
+        return self.xmin, self.ymin, self.xmax, self.ymax
+
+    def contains(self, bbox):
+        return self.xmin <= bbox[0] and bbox[2] <= self.xmax and self.ymin <= bbox[1] and bbox[3] <= self.ymax
+
+    def grow_to(self, bbox):
+        # grow a new root around the tree, doubling it towards the bbox as many times as it takes to contain it
+        # the old root becomes one of the new root's quadrants and keeps its whole subtree, only the node depths change,
+        # and max_depth grows along so the smallest cells stay the same size
+        # items reaching the old bounds on the growing sides may now also belong in the new quadrants, so those are reinserted
+        # the new root is merged right away if its items fit in one leaf, as a fresh build with the new bounds would have it
+        self.check_nodes('grow_to')
+        session = active_session(self.pk)
+        if session is not None:
+            # pending counts belong to the old nodes
+            session.flush()
+        while not self.contains(bbox):
+            bounds,quad = grown_bounds(self.bounds(), bbox)
+            root = Node(index=self, depth=0, item_count=None, xmin=bounds[0], ymin=bounds[1], xmax=bounds[2], ymax=bounds[3])
+            moved = [(item.item_id, item_bbox(item)) for item in self.items_reaching(root.center, quad)
+                     if quadrants(root.center, item_bbox(item)) != [quad]]
+            with transaction.atomic():
+                self.remove_many(moved)
+                oldroot = Node.objects.get(pk=self.root_id)
+                Node.objects.filter(index=self).update(depth=F('depth') + 1)
+                root.subtree_count = oldroot.subtree_count
+                root.save()
+                for sub,(x1,y1,x2,y2) in enumerate(root.quadrant_bounds(), 1):
+                    if sub != quad:
+                        Node.objects.create(index=self, parent=root, depth=1, item_count=0, xmin=x1, ymin=y1, xmax=x2, ymax=y2)
+                Node.objects.filter(pk=oldroot.pk).update(parent=root)
+                self.xmin,self.ymin,self.xmax,self.ymax = bounds
+                self.max_depth += 1
+                self.root = root
+                self.save(update_fields=['xmin', 'ymin', 'xmax', 'ymax', 'max_depth', 'root'])
+                bump_version(self.pk)
+                self.forget_skeleton()
+                if self.collapse(self.skeleton(), [0]):
+                    self.forget_skeleton()
+                self.insert_many(moved)
+
+    def items_reaching(self, center, quad):
+        # the Item instances of the tree that reach the center lines of a grown root with the old root as quadrant quad,
+        # a superset of those that belong in other quadrants of the grown root
+        cx,cy = center
+        left = quad in (2, 4)
+        low = quad in (3, 4)
+        if self.engine == ENGINE_PACKED:
+            items = {}
+            for payload in Node.objects.filter(index=self, payload__isnull=False).values_list('payload', flat=True):
+                for item in unpack_payload(bytes(payload)):
+                    if (item.xmin <= cx if left else item.xmax > cx) or (item.ymin <= cy if low else item.ymax >= cy):
+                        items[item.pk] = item
+            return list(items.values())
+        xcheck = Q(xmin__lte=cx) if left else Q(xmax__gt=cx)
+        ycheck = Q(ymin__lte=cy) if low else Q(ymax__gte=cy)
+        return list(Item.objects.filter(xcheck | ycheck, links__node__index=self).distinct())
 
     # Methods
 
-    def build(self, items, chunksize=1000):
+    def build(self, items, chunksize=1000, bulk=False, progress=None):
+        # replaces whatever an earlier build or insert left in the tree, see clear()
+        if bulk:
+            self.bulk_build(items)
+            return
+
+        self.clear()
         self.create_root()
-        
-        # first create all items (efficiently)
-##        def iterchunks():
-##            i = 0
-##            while True:
-##                chunk = [Item(item_id=item_id, xmin=bbox[0], ymin=bbox[1], xmax=bbox[2], ymax=bbox[3])
-##                         for item_id,bbox in islice(items, i, i+chunksize)]
-##                if len(chunk):
-##                    yield chunk
-##                    i += chunksize
-##                else:
-##                    break
-##        #print('begin chunking')
-##        for chunk in iterchunks():
-##            #print('chunk create')
-##            Item.objects.bulk_create(chunk)
-##
-##        # then insert them into the tree
-##        #print('insert')
-##        for item in Item.objects.all():
-##            self.root.insert(item)
-
-        # simpler approach
-        for item_id,bbox in items:
+        self.insert_many(items, chunksize, progress)
+
+    def clear(self):
+        # delete the nodes, links and items of the tree, leaving it unbuilt
+        # items are only reachable through the tree, so they would otherwise stay behind for good
+        cursor = connection.cursor()
+        with transaction.atomic():
+            if self.engine == ENGINE_RTREE:
+                self.create_rtree()
+                cursor.execute(rtree_sql(RTREE_DELETE_ITEMS_SQL, self))
+                cursor.execute(rtree_sql(RTREE_CLEAR_SQL, self))
+                return
+            if self.engine == ENGINE_PACKED:
+                pks = set()
+                for payload in Node.objects.filter(index=self, payload__isnull=False).values_list('payload', flat=True):
+                    pks.update(entry[0] for entry in struct_iter(PAYLOAD_FORMAT, bytes(payload)))
+                cursor.executemany(DELETE_ITEM_SQL, [(pk,) for pk in pks])
+            else:
+                cursor.execute(DELETE_TREE_ITEMS_SQL, [self.pk])
+                cursor.execute(DELETE_TREE_LINKS_SQL, [self.pk])
+            self.root = None
+            self.save(update_fields=['root'])
+            cursor.execute(DELETE_TREE_NODES_SQL, [self.pk])
+            bump_version(self.pk)
+        self.forget_skeleton()
+
+    def insert_many(self, items, chunksize=1000, progress=None):
+        # add (item_id, bbox) pairs to an existing tree
+        # stream the items in fixed-size chunks, consuming the iterable only once
+        # each chunk is created in bulk and inserted into the tree in one transaction
+        # progress is an optional callback(items_done, seconds_elapsed)
+        if self.root_id is None and self.engine != ENGINE_RTREE:
+            self.create_root()
+        start = time.time()
+        done = 0
+        for chunk in iterchunks(items, chunksize):
+            chunk = [Item(item_id=item_id, xmin=bbox[0], ymin=bbox[1], xmax=bbox[2], ymax=bbox[3])
+                     for item_id,bbox in chunk]
+            if self.engine == ENGINE_RTREE:
+                with transaction.atomic():
+                    backend().bulk_insert(Item, chunk)
+                    self.rtree_add(chunk)
+                done += len(chunk)
+                if progress:
+                    progress(done, time.time() - start)
+                continue
+            with self.insert_session():
+                backend().bulk_insert(Item, chunk)
+                skeleton = self.skeleton()
+                for item in chunk:
+                    if self.grow and not self.contains(item_bbox(item)):
+                        self.grow_to(item_bbox(item))
+                        skeleton = self.skeleton()
+                    skeleton.insert(item)
+            done += len(chunk)
+            if progress:
+                progress(done, time.time() - start)
+
+    def insert(self, item_id, bbox):
+        # add a single item to an existing tree
+        # rtree trees have no root, their virtual table is made when they are saved
+        if self.root_id is None and self.engine != ENGINE_RTREE:
+            self.create_root()
+        if self.engine == ENGINE_RTREE:
             item = Item.objects.create(item_id=item_id, xmin=bbox[0], ymin=bbox[1], xmax=bbox[2], ymax=bbox[3])
-            self.root.insert(item)
+            self.rtree_add([item])
+            return item
+        # in a session, so the subtree counts of the ancestors are added at the end of the insert,
+        # or of the caller's session, rather than locking the root from the start of the insert
+        with self.insert_session():
+            item = Item.objects.create(item_id=item_id, xmin=bbox[0], ymin=bbox[1], xmax=bbox[2], ymax=bbox[3])
+            skeleton = self.skeleton()
+            if self.grow and not self.contains(bbox):
+                self.grow_to(bbox)
+                skeleton = self.skeleton()
+            skeleton.insert(item)
+        return item
+
+    def remove(self, item_id, bbox=None):
+        # remove an item from the tree, returns the number of items removed
+        # without a bbox every bbox stored for the item_id is tried, which has to look through all items
+        if bbox is not None:
+            return self.remove_many([(item_id, bbox)])
+        bboxes = set(Item.objects.filter(item_id=item_id).values_list('xmin', 'ymin', 'xmax', 'ymax'))
+        return self.remove_many([(item_id, bbox) for bbox in bboxes])
+
+    def remove_many(self, items):
+        # remove (item_id, bbox) pairs from the tree in one transaction, returns the number of items removed
+        # items are looked for in the nodes an insert of the bbox goes to, every item there with the same item_id and bbox is removed
+        # node counts are decremented, and sibling leaves whose items fit in one leaf again are merged, see collapse()
+        items = [(item_id, tuple(bbox)) for item_id,bbox in items]
+        if self.engine == ENGINE_RTREE:
+            return self.rtree_remove_many(items)
+        if not items or self.root_id is None:
+            return 0
+        with transaction.atomic():
+            skeleton = self.skeleton()
+            wanted = {} # slot -> (item_id, bbox) keys
+            for key in items:
+                for slot in skeleton.leaves(key[1]):
+                    wanted.setdefault(slot, set()).add(key)
+            rows = self.node_item_rows(skeleton.ids[slot] for slot in wanted)
+            removed = {} # item pk -> bbox
+            deltas = {} # node id -> count decrement
+            for slot,keys in wanted.items():
+                nodeid = skeleton.ids[slot]
+                noderows = rows.get(nodeid, [])
+                kept = [row for row in noderows if (row[1], tuple(row[2:])) not in keys]
+                if len(kept) == len(noderows):
+                    continue
+                for row in noderows:
+                    if (row[1], tuple(row[2:])) in keys:
+                        removed[row[0]] = tuple(row[2:])
+                deltas[nodeid] = len(noderows) - len(kept)
+                if skeleton.counts[slot] >= 0:
+                    skeleton.counts[slot] -= deltas[nodeid]
+                if self.engine == ENGINE_PACKED:
+                    payload = pack_payload([Item(*row) for row in kept]) if kept else None
+                    count = len(kept) if skeleton.children[slot] < 0 else None
+                    connection.cursor().execute(SETPAYLOAD_SQL, [payload, count, nodeid])
+            if not removed:
+                return 0
+            cursor = connection.cursor()
+            if self.engine != ENGINE_PACKED:
+                cursor.executemany(ADD_COUNT_SQL, [(-delta, nodeid) for nodeid,delta in deltas.items()])
+            owned = {}
+            for bbox in removed.values():
+                for slot in skeleton.owner_path(bbox):
+                    owned[skeleton.ids[slot]] = owned.get(skeleton.ids[slot], 0) + 1
+            cursor.executemany(ADD_SUBTREE_SQL, [(-delta, nodeid) for nodeid,delta in owned.items()])
+            pks = [(pk,) for pk in removed]
+            if self.engine != ENGINE_PACKED:
+                cursor.executemany(DELETE_ITEM_LINKS_SQL, pks)
+            cursor.executemany(DELETE_ITEM_SQL, pks)
+            # merge bottom up, starting from the branches whose leaves or own items lost items
+            slots = set()
+            for nodeid in deltas:
+                slot = skeleton.slots[nodeid]
+                slots.add(slot if skeleton.children[slot] >= 0 else skeleton.parents[slot])
+            collapsed = self.collapse(skeleton, slots)
+            # other processes reload their skeletons, whose counts are now too high
+            skeleton.version = bump_version(self.pk, None if collapsed else skeleton.version)
+            if skeleton.version is None:
+                self.forget_skeleton()
+        return len(removed)
+
+    def collapse(self, skeleton, slots):
+        # turn each branch slot back into a leaf if its four subnodes are leaves whose distinct items the policy merges
+        # merged branches then have their parent tried, returns the number of branches merged
+        # the skeleton is only updated as far as needed here and has to be reloaded afterwards
+        cursor = connection.cursor()
+        policy = self.policy()
+        pending = set(slot for slot in slots if slot >= 0)
+        collapsed = 0
+        while pending:
+            slot = max(pending, key=lambda slot: skeleton.depths[slot])
+            pending.discard(slot)
+            first = skeleton.children[slot]
+            if first < 0:
+                continue
+            subs = range(first, first + 4)
+            # a subnode that is a branch rules out a merge without querying
+            if any(skeleton.children[sub] >= 0 for sub in subs):
+                continue
+            nodeid = skeleton.ids[slot]
+            subids = [skeleton.ids[sub] for sub in subs]
+            rows = self.node_item_rows([nodeid] + subids)
+            items = {} # item pk -> row, items spanning several subnodes once
+            for row in chain.from_iterable(rows.values()):
+                items[row[0]] = row
+            if not policy.should_merge(self, skeleton.depths[slot], len(items), lambda: [row[2:6] for row in items.values()]):
+                continue
+            if self.engine == ENGINE_PACKED:
+                payload = pack_payload([Item(*row) for row in items.values()]) if items else None
+            else:
+                # multilevel branches already link their own items
+                own = set(row[0] for row in rows.get(nodeid, []))
+                cursor.executemany(ADDITEM_SQL, [(pk, nodeid) for pk in items if pk not in own])
+                payload = None
+            cursor.execute(SETPAYLOAD_SQL, [payload, len(items), nodeid])
+            # the subnodes are leaves, so nothing but their links refers to them
+            cursor.executemany(CLEARLINKS_SQL, [(subid,) for subid in subids])
+            cursor.executemany(DELETE_NODE_SQL, [(subid,) for subid in subids])
+            skeleton.children[slot] = -1
+            skeleton.counts[slot] = len(items)
+            collapsed += 1
+            if skeleton.parents[slot] >= 0:
+                pending.add(skeleton.parents[slot])
+        return collapsed
+
+    def compact(self, chunksize=500):
+        # maintenance for a tree degraded by many inserts and removals, which can run while the tree is in use
+        # every step commits after at most chunksize nodes, bumping the version so that other processes reload their skeletons
+        # empty leaves are only dropped when their sibling group merges, every branch needs all four quadrants
+        # returns the node and link counts before and after, and what was done
+        self.check_nodes('compact')
+        before = self.storage_counts()
+        unreachable = self.delete_unreachable(chunksize)
+        merged = self.collapse_all(chunksize)
+        self.renumber(chunksize)
+        after = self.storage_counts()
+        return {'nodes': (before[0], after[0]),
+                'links': (before[1], after[1]),
+                'unreachable': unreachable,
+                'merged': merged}
+
+    def storage_counts(self):
+        # the number of node and link rows of the tree
+        return (Node.objects.filter(index=self).count(),
+                ItemNodeLink.objects.filter(node__index=self).count())
+
+    def delete_unreachable(self, chunksize=500):
+        # delete the nodes that can't be reached from the root through branches, such as those left behind by an interrupted split,
+        # deepest first so that no remaining node refers to a deleted one, returns the number of nodes deleted
+        self.refresh_from_db(fields=['root'])
+        rows = list(Node.objects.filter(index=self).values_list('id', 'parent_id', 'item_count', 'depth'))
+        children = {}
+        for nodeid,parentid,item_count,depth in rows:
+            children.setdefault(parentid, []).append(nodeid)
+        branches = set(nodeid for nodeid,_,item_count,_ in rows if item_count is None)
+        reachable = set()
+        stack = [self.root_id] if self.root_id is not None else []
+        while stack:
+            nodeid = stack.pop()
+            reachable.add(nodeid)
+            if nodeid in branches:
+                stack.extend(children.get(nodeid, []))
+        unreachable = sorted(((depth, nodeid) for nodeid,_,_,depth in rows if nodeid not in reachable), reverse=True)
+        unreachable = [(nodeid,) for _,nodeid in unreachable]
+        cursor = connection.cursor()
+        for start in range(0, len(unreachable), chunksize):
+            with transaction.atomic():
+                chunk = unreachable[start:start+chunksize]
+                cursor.executemany(CLEARLINKS_SQL, chunk)
+                cursor.executemany(DELETE_NODE_SQL, chunk)
+                bump_version(self.pk)
+        return len(unreachable)
+
+    def collapse_all(self, chunksize=500):
+        # merge every group of sibling leaves whose items the policy merges, see collapse()
+        # branches with only leaves below them are tried deepest first, chunksize of them per transaction,
+        # and the list is made again if another process changed the tree meanwhile, returns the number of branches merged
+        examined = set()
+        skeleton = None
+        queue = []
+        merged = 0
+        while True:
+            with transaction.atomic():
+                current = self.skeleton()
+                if current is not skeleton:
+                    skeleton = current
+                    queue = [slot for slot in range(len(skeleton.ids))
+                             if skeleton.children[slot] >= 0 and skeleton.ids[slot] not in examined
+                             and all(skeleton.children[sub] < 0 for sub in range(skeleton.children[slot], skeleton.children[slot] + 4))]
+                    queue.sort(key=lambda slot: skeleton.depths[slot], reverse=True)
+                if not queue:
+                    break
+                chunk,queue = queue[:chunksize],queue[chunksize:]
+                examined.update(skeleton.ids[slot] for slot in chunk)
+                collapsed = self.collapse(skeleton, chunk)
+                if collapsed:
+                    # the skeleton was kept up to date by collapse, so it stays valid for this process,
+                    # unless another process changed the tree meanwhile
+                    skeleton.version = bump_version(self.pk, skeleton.version)
+                merged += collapsed
+        self.forget_skeleton()
+        return merged
+
+    def renumber(self, chunksize=500):
+        # rewrite the nodes and their links in tree order, the four subnodes of each branch together, depth first,
+        # so that the rows a query reads are stored close together
+        # nodes are copied to new ids chunksize at a time, their subnodes and links moved to the copies, then the originals deleted
+        # nodes added by other processes meanwhile are kept where they are
+        skeleton = self.skeleton()
+        if not skeleton.ids:
+            # an unbuilt tree has no nodes to rewrite
+            return
+        order = [0]
+        stack = [0]
+        while stack:
+            first = skeleton.children[stack.pop()]
+            if first >= 0:
+                subs = list(range(first, first + 4))
+                order.extend(subs)
+                stack.extend(reversed(subs))
+        oldids = [skeleton.ids[slot] for slot in order]
+        newids = {}
+        cursor = connection.cursor()
+        for start in range(0, len(oldids), chunksize):
+            with transaction.atomic():
+                nodes = Node.objects.in_bulk(oldids[start:start+chunksize])
+                chunk = [nodeid for nodeid in oldids[start:start+chunksize] if nodeid in nodes]
+                copies = []
+                for nodeid in chunk:
+                    node = nodes[nodeid]
+                    node.pk = None
+                    node.parent_id = newids.get(node.parent_id, node.parent_id)
+                    copies.append(node)
+                backend().bulk_insert(Node, copies)
+                moves = []
+                for nodeid,copy in zip(chunk, copies):
+                    newids[nodeid] = copy.pk
+                    moves.append((copy.pk, nodeid))
+                cursor.executemany(MOVE_SUBNODES_SQL, moves)
+                if self.engine != ENGINE_PACKED:
+                    cursor.executemany(COPY_LINKS_SQL, moves)
+                    cursor.executemany(CLEARLINKS_SQL, [(nodeid,) for nodeid in chunk])
+                self.refresh_from_db(fields=['root'])
+                if self.root_id in newids:
+                    self.root_id = newids[self.root_id]
+                    self.save(update_fields=['root'])
+                cursor.executemany(DELETE_NODE_SQL, [(nodeid,) for nodeid in chunk])
+                bump_version(self.pk)
+        self.forget_skeleton()
+
+    def insert_session(self):
+        # context manager that runs inserts in one transaction,
+        # buffering node count updates until the end
+        return InsertSession(self)
+
+    def skeleton(self):
+        # the in-memory node skeleton of this tree, reloaded if another process changed the tree
+        cursor = connection.cursor()
+        cursor.execute(VERSION_SQL, [self.pk])
+        version = cursor.fetchone()[0]
+        skeletons = cached_skeletons()
+        skeleton = skeletons.get(self.pk)
+        if skeleton is None or skeleton.version != version:
+            # another process may have grown the tree
+            self.refresh_from_db(fields=['xmin', 'ymin', 'xmax', 'ymax', 'max_depth', 'root'])
+            skeleton = NodeSkeleton(self, version)
+            skeletons[self.pk] = skeleton
+        skeleton.tree = self
+        return skeleton
 
-    def intersect(self, bbox):
-        # TODO: MAYBE ALLOWS SENDING IN CUSTOM MODEL TO RETRIEVE FROM THOSE
+    def forget_skeleton(self):
+        cached_skeletons().pop(self.pk, None)
+
+    def bulk_build(self, items):
+        # partition all items in memory, following the exact same insert/split
+        # rules as Node.insert, so the result is identical to an incremental build
+        self.clear()
+        if self.engine == ENGINE_RTREE:
+            # nothing to partition, the virtual table is built row by row
+            self.create_root()
+            self.insert_many(items, BULK_BATCH_SIZE)
+            return
+        if self.grow:
+            # grow the bounds first, the same way an incremental build would
+            items = list(items)
+            for _,bbox in items:
+                while not self.contains(bbox):
+                    bounds,_ = grown_bounds(self.bounds(), bbox)
+                    self.xmin,self.ymin,self.xmax,self.ymax = bounds
+                    self.max_depth += 1
+            self.save(update_fields=['xmin', 'ymin', 'xmax', 'ymax', 'max_depth'])
+        root = Node(index=self, depth=0, item_count=0, code=self.root_code(), xmin=self.xmin, ymin=self.ymin, xmax=self.xmax, ymax=self.ymax)
+        root.init_memory(None)
+        allnodes = [root]
+        allitems = []
+        for item_id,bbox in items:
+            item = Item(item_id=item_id, xmin=bbox[0], ymin=bbox[1], xmax=bbox[2], ymax=bbox[3])
+            allitems.append(item)
+            root.memory_insert(item, allnodes)
+
+        # then write everything with a few bulk inserts
+        # nodes are written one depth level at a time so parent ids are known
+        db = backend()
+        with transaction.atomic():
+            db.bulk_insert(Item, allitems)
+            levels = {}
+            for node in allnodes:
+                levels.setdefault(node.depth, []).append(node)
+            for depth in sorted(levels.keys()):
+                level = levels[depth]
+                for node in level:
+                    if node._mem_parent is not None:
+                        node.parent_id = node._mem_parent.pk
+                    if self.engine == ENGINE_PACKED and node._mem_items:
+                        node.payload = pack_payload(node._mem_items)
+                db.bulk_insert(Node, level)
+            if self.engine != ENGINE_PACKED:
+                links = [ItemNodeLink(node_id=node.pk, item_id=item.pk)
+                         for node in allnodes
+                         for item in node._mem_items]
+                db.bulk_insert(ItemNodeLink, links, pks=False)
+            self.root = root
+            self.save(update_fields=['root'])
+            bump_version(self.pk)
+        self.forget_skeleton()
+
+    def intersect(self, bbox, unique=True):
+        # to get instances of another model instead, filter it with the quadtree__intersects lookup, see QuadTreeItem
+        # each item is returned once, unless unique=False in which case items linked into several
+        # of the matching leaves are returned once per leaf, as before
+        if self.engine == ENGINE_RTREE:
+            return Item.objects.raw(rtree_sql(RTREE_INTERSECT_SQL, self), bounds_params(bbox) * 2)
+        if self.engine == ENGINE_LINEAR:
+            return self.linear_intersect(bbox, unique)
+        if self.engine == ENGINE_PACKED:
+            return self.packed_intersect(bbox)
         # query
-        x1,y1,x2,y2 = bbox
-        #boundscheck = 'NOT ({x1} > xmax OR {x2} < xmin OR {y1} > ymax OR {y2} < ymin)'.format(x1=x1, y1=y1, x2=x2, y2=y2)
-        boundscheck = '({x1} < xmax AND {x2} > xmin) AND ({y1} < ymax AND {y2} > ymin)'.format(x1=x1, y1=y1, x2=x2, y2=y2)
-        #from django.db import connection
-        #res = connection.cursor().execute('''
-        res = Item.objects.raw('''
-                        WITH nodes AS
-                            (SELECT * FROM {nodes_table} WHERE index_id = {index}),
-                        traversal AS
-                          (SELECT id AS nodeid, depth, CAST(id AS text) AS path
-                           FROM nodes
-                           WHERE parent_id IS NULL AND {boundscheck}
-
-                           UNION ALL
-
-                           SELECT nodes.id AS nodeid, nodes.depth, CAST(path || '.' || CAST(nodes.id AS text) AS text) AS path
-                           FROM nodes
-                           INNER JOIN traversal
-                           ON traversal.nodeid = nodes.parent_id AND {boundscheck}
-                           ),
-                        travlinks AS
-                            (SELECT links.item_id,traversal.depth,traversal.path
-                            FROM {links_table} AS links, traversal
-                            WHERE links.node_id = traversal.nodeid)
-
-                       -- Extract
-                       SELECT items.id AS id, items.item_id, items.xmin, items.ymin, items.xmax, items.ymax
-                       FROM {items_table} AS items
-                       INNER JOIN travlinks ON items.id = travlinks.item_id
-                       WHERE {boundscheck}
-                        '''.format(boundscheck=boundscheck,
-                                   index=self.pk,
-                                   nodes_table=Node._meta.db_table,
-                                   items_table=Item._meta.db_table,
-                                   links_table=ItemNodeLink._meta.db_table,
-                                   ))
-        #print 'len',len(res.fetchall())
+        params = intersect_params(self, bbox)
+        if unique:
+            res = Item.objects.raw(INTERSECT_SQL, params + refcheck_params(self, bbox))
+        else:
+            res = Item.objects.raw(INTERSECT_ALL_SQL, params)
         #print res.query
         return res
 
+    def intersect_count(self, bbox):
+        # the number of distinct items intersecting the bbox, without fetching them
+        # nodes strictly inside the bbox add their subtree_count and are not descended into,
+        # only the items of nodes on the bbox boundary are looked at, with the same reference point rule as intersect
+        boundsparams = bounds_params(bbox)
+        containparams = containcheck_params(self, bbox)
+        params = containparams + [self.root_id] + boundsparams + containparams + boundsparams
+        cursor = connection.cursor()
+        if self.engine == ENGINE_RTREE:
+            cursor.execute(rtree_sql(RTREE_COUNT_SQL, self), boundsparams * 2)
+            return cursor.fetchone()[0]
+        if self.engine == ENGINE_PACKED:
+            cursor.execute(PACKED_COUNT_SQL, params)
+            count = 0
+            for contained,subtree_count,item_count,xmin,ymin,xmax,ymax,payload in cursor:
+                if contained:
+                    count += subtree_count
+                elif payload is not None:
+                    items = filter_payload(bytes(payload), bbox)
+                    if item_count is not None:
+                        items = [item for item in items
+                                 if owns_reference((xmin,ymin,xmax,ymax), self.bounds(), bbox, item_bbox(item))]
+                    count += len(items)
+            return count
+        cursor.execute(COUNT_SQL, params + boundsparams + refcheck_params(self, bbox))
+        contained,boundary = cursor.fetchone()
+        return contained + boundary
+
+    def intersect_point(self, x, y):
+        # the items whose bbox contains the point, edges included
+        # the point only ever goes down one path, which is followed in the cached skeleton,
+        # then only the items of its leaf are tested, and those of the branches on the way for multilevel trees
+        if self.engine == ENGINE_RTREE:
+            return list(Item.objects.raw(rtree_sql(RTREE_POINT_SQL, self), [x, x, y, y] * 2))
+        if self.root_id is None:
+            return []
+        skeleton = self.skeleton()
+        nodeids = [skeleton.ids[slot] for slot in skeleton.point_path(x, y)]
+        if not self.multilevel:
+            nodeids = nodeids[-1:]
+        cursor = connection.cursor()
+        if self.engine == ENGINE_PACKED:
+            cursor.execute(point_sql(len(nodeids), packed=True), nodeids)
+            return [item for payload, in cursor
+                    for item in unpack_payload(bytes(payload))
+                    if item.xmin <= x <= item.xmax and item.ymin <= y <= item.ymax]
+        cursor.execute(point_sql(len(nodeids)), nodeids + [x, x, y, y])
+        return [Item(*row) for row in cursor]
+
+    def node_item_rows(self, nodeids):
+        # the (pk, item_id, xmin, ymin, xmax, ymax) rows of the items stored on some nodes, by node id
+        # nodes without items are left out
+        cursor = connection.cursor()
+        rows = {}
+        packed = self.engine == ENGINE_PACKED
+        for row in backend().node_rows(cursor, list(nodeids), packed):
+            if packed:
+                rows[row[0]] = list(struct_iter(PAYLOAD_FORMAT, bytes(row[1])))
+            else:
+                rows.setdefault(row[0], []).append(row[1:])
+        return rows
+
+    def join(self, other):
+        # yield the (item_id, other_item_id) pairs of items in this and another tree whose bboxes overlap
+        # the two node skeletons are walked together, expanding one side of a node pair at a time,
+        # node pairs whose bounds do not meet are pruned, and the items of each node are read at most once,
+        # batched per chunk of node pairs
+        # a pair of items linked into several leaves is only reported from the leaves owning the lower left corner of their overlap
+        self.check_nodes('join')
+        other.check_nodes('join')
+        if self.root_id is None or other.root_id is None:
+            return
+        trees = self, other
+        skeletons = self.skeleton(), other.skeleton()
+        treebounds = self.bounds(), other.bounds()
+        edges = {}, {} # slot -> edge bounds
+        cached = {}, {} # slot -> item rows
+
+        def region(side, slot):
+            if slot not in edges[side]:
+                edges[side][slot] = edge_bounds(skeletons[side].bounds[slot*4:slot*4+4], treebounds[side])
+            return edges[side][slot]
+
+        def expand(side, node):
+            # the four subnodes of a branch, and for multilevel trees the items kept on the branch itself
+            # leaves and the items of a branch are (slot, True), nodes still to expand are (slot, False)
+            first = skeletons[side].children[node]
+            subs = [(first + quad, skeletons[side].children[first + quad] < 0) for quad in range(4)]
+            if trees[side].multilevel:
+                subs.append((node, True))
+            return subs
+
+        def node_pairs():
+            # the pairs of leaves or branch items whose regions meet
+            stack = [((0, skeletons[0].children[0] < 0), (0, skeletons[1].children[0] < 0))]
+            while stack:
+                a,b = stack.pop()
+                if not bounds_meet(region(0, a[0]), region(1, b[0])):
+                    continue
+                if a[1] and b[1]:
+                    yield a,b
+                elif not a[1] and (b[1] or skeletons[0].area(a[0]) >= skeletons[1].area(b[0])):
+                    stack.extend((sub, b) for sub in expand(0, a[0]))
+                else:
+                    stack.extend((a, sub) for sub in expand(1, b[0]))
+
+        def owns(side, node, corner):
+            slot,_ = node
+            return skeletons[side].children[slot] >= 0 or owns_corner(skeletons[side].bounds[slot*4:slot*4+4], treebounds[side], corner)
+
+        pairs = node_pairs()
+        while True:
+            chunk = list(islice(pairs, IN_BATCH_SIZE))
+            if not chunk:
+                break
+            for side in (0, 1):
+                missing = set(pair[side][0] for pair in chunk if pair[side][0] not in cached[side])
+                rows = trees[side].node_item_rows(skeletons[side].ids[slot] for slot in missing)
+                for slot in missing:
+                    cached[side][slot] = rows.get(skeletons[side].ids[slot], [])
+            for a,b in chunk:
+                for apk,aid,ax1,ay1,ax2,ay2 in cached[0][a[0]]:
+                    for bpk,bid,bx1,by1,bx2,by2 in cached[1][b[0]]:
+                        if ax1 < bx2 and ax2 > bx1 and ay1 < by2 and ay2 > by1:
+                            corner = max(ax1, bx1), max(ay1, by1)
+                            if owns(0, a, corner) and owns(1, b, corner):
+                                yield aid, bid
+
+    def nearest(self, point, k=1):
+        # the k items closest to the point by bbox distance, nearest first, each with a distance attribute
+        # best-first search, a node's subnodes and items are only read once it is the closest thing left
+        # nodes and items are kept as plain rows, only the results become Item instances
+        self.check_nodes('nearest')
+        cursor = connection.cursor()
+        cursor.execute(NEAREST_ROOT_SQL, [self.root_id])
+        heap = [(0.0, 0, True, row) for row in cursor] # distance, push order to break ties, is node, row
+        pushed = 1
+        results = []
+        seen = set()
+        while heap and len(results) < k:
+            dist,_,isnode,row = heapq.heappop(heap)
+            if not isnode:
+                if row[0] not in seen:
+                    seen.add(row[0])
+                    item = Item(*row)
+                    item.distance = dist
+                    results.append(item)
+                continue
+            nodeid,item_count = row[0],row[1]
+            if item_count is not None or self.multilevel:
+                for item in self.node_item_rows([nodeid]).get(nodeid, []):
+                    if item[0] not in seen:
+                        heapq.heappush(heap, (bbox_distance(point, item[2:]), pushed, False, item))
+                        pushed += 1
+            if item_count is None:
+                cursor.execute(NEAREST_CHILDREN_SQL, [nodeid])
+                for sub in cursor.fetchall():
+                    heapq.heappush(heap, (node_distance(point, sub[2:], self.bounds()), pushed, True, sub))
+                    pushed += 1
+        return results
+
+    def packed_intersect(self, bbox):
+        # traverse the nodes as usual, then filter the items of their packed payloads in python
+        # payloads of nodes inside the bbox are taken whole
+        cursor = connection.cursor()
+        cursor.execute(PACKED_INTERSECT_SQL, intersect_params(self, bbox)[:-4])
+        results = {}
+        for contained,payload in cursor:
+            for item in filter_payload(bytes(payload), None if contained else bbox):
+                results[item.pk] = item
+        return list(results.values())
+
+    def iter_intersect(self, bbox, chunksize=STREAM_CHUNK_SIZE):
+        # yield the items intersecting the bbox, each once, without holding the whole result in memory
+        # rows are fetched chunksize at a time, on postgresql from a server-side cursor
+        if self.engine == ENGINE_RTREE:
+            sql,params = rtree_sql(RTREE_INTERSECT_SQL, self), bounds_params(bbox) * 2
+        elif self.engine == ENGINE_PACKED:
+            sql,params = PACKED_INTERSECT_SQL, intersect_params(self, bbox)[:-4]
+        elif self.engine == ENGINE_LINEAR:
+            query = self.linear_intersect_query(bbox, unique=True)
+            if query is None:
+                return
+            sql,params = query
+        else:
+            sql,params = INTERSECT_SQL, intersect_params(self, bbox) + refcheck_params(self, bbox)
+        seen = set()
+        with backend().stream_cursor() as cursor:
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(chunksize)
+                if not rows:
+                    break
+                for row in rows:
+                    if self.engine != ENGINE_PACKED:
+                        yield Item(*row)
+                        continue
+                    # items of packed trees may be in several payloads
+                    contained,payload = row
+                    for item in filter_payload(bytes(payload), None if contained else bbox):
+                        if item.pk not in seen:
+                            seen.add(item.pk)
+                            yield item
+
+    def linear_cells(self, bbox):
+        # cover the bbox with aligned cells, at the deepest level where it takes at most LINEAR_MAX_CELLS
+        x1,y1,x2,y2 = bbox
+        width = self.xmax - self.xmin
+        height = self.ymax - self.ymin
+        cells = None
+        for level in range(self.max_depth + 1):
+            n = 2 ** level
+            ix1 = min(max(int(math.floor((x1 - self.xmin) / width * n)), 0), n-1)
+            ix2 = min(max(int(math.floor((x2 - self.xmin) / width * n)), 0), n-1)
+            iy1 = min(max(int(math.floor((y1 - self.ymin) / height * n)), 0), n-1)
+            iy2 = min(max(int(math.floor((y2 - self.ymin) / height * n)), 0), n-1)
+            if (ix2-ix1+1) * (iy2-iy1+1) > LINEAR_MAX_CELLS:
+                break
+            cells = [(level, ix, iy) for ix in range(ix1, ix2+1) for iy in range(iy1, iy2+1)]
+        return cells
+
+    def linear_ranges(self, bbox):
+        # the node code ranges covering the bbox cells and everything below them,
+        # and the codes of the cells' ancestors, which may be leaves containing them
+        ranges = []
+        ancestors = set()
+        prefixes = []
+        for level,ix,iy in self.linear_cells(bbox):
+            span = 4 ** (LINEAR_LEVELS - level)
+            prefix = interleave(ix, iy) * span
+            prefixes.append((prefix, span, level))
+            for depth in range(level):
+                anc = prefix - prefix % (4 ** (LINEAR_LEVELS - depth))
+                ancestors.add((anc << LINEAR_DEPTH_BITS) + depth)
+        # merge adjacent cells into one range
+        for prefix,span,level in sorted(prefixes):
+            start = (prefix << LINEAR_DEPTH_BITS) + level
+            end = ((prefix + span) << LINEAR_DEPTH_BITS) - 1
+            if ranges and ranges[-1][1] + 1 >= start:
+                ranges[-1][1] = end
+            else:
+                ranges.append([start, end])
+        return ranges, sorted(ancestors)
+
+    def linear_intersect(self, bbox, unique=True):
+        # find the leaves with a few indexed range scans on the node codes instead of recursive traversal
+        query = self.linear_intersect_query(bbox, unique)
+        if query is None:
+            return Item.objects.none()
+        return Item.objects.raw(*query)
+
+    def linear_intersect_query(self, bbox, unique=True):
+        # the sql and params of a linear intersect, or None if the bbox misses the tree
+        x1,y1,x2,y2 = bbox
+        if not (x1 < self.xmax and x2 > self.xmin and y1 < self.ymax and y2 > self.ymin):
+            return None
+        ranges,ancestors = self.linear_ranges(bbox)
+        params = []
+        for start,end in ranges:
+            params.extend([self.pk, start, end])
+        if ancestors:
+            params.append(self.pk)
+            params.extend(ancestors)
+        params.extend(bounds_params(bbox))
+        if unique:
+            params.extend(bounds_params(bbox))
+            params.extend(refcheck_params(self, bbox))
+        return linear_intersect_sql(len(ranges), len(ancestors), unique), params
+
+    def intersect_subquery(self, bbox):
+        # the sql and params of a single column of the item ids intersecting the bbox, to be used as IN (sql)
+        # items linked into several leaves may be listed more than once, which IN does not mind
+        if self.engine == ENGINE_RTREE:
+            return SUBQUERY_SQL.format(sql=rtree_sql(RTREE_INTERSECT_SQL, self)), bounds_params(bbox) * 2
+        if self.engine == ENGINE_PACKED:
+            # the items would have to be intersected in python while the statement is compiled, and listed as params
+            raise ValueError('Packed trees can not be intersected in a subquery, the database can not read their payloads')
+        if self.engine == ENGINE_LINEAR:
+            query = self.linear_intersect_query(bbox, unique=False)
+            if query is None:
+                return 'NULL', []
+            sql,params = query
+        else:
+            sql,params = INTERSECT_ALL_SQL, intersect_params(self, bbox)
+        return SUBQUERY_SQL.format(sql=sql), params
+
+    def intersect_many(self, bboxes, unique=True):
+        # intersect several bboxes with a single traversal query
+        # each returned item is tagged with the query_index of the bbox it matched,
+        # and returned once per bbox unless unique=False
+        # bboxes are only split over several queries if they exceed the backend's parameter limit
+        bboxes = list(bboxes)
+        results = []
+        # the root id, and the refcheck for unique results from links
+        if self.engine == ENGINE_RTREE:
+            extra = 0
+        elif unique and self.engine != ENGINE_PACKED:
+            extra = 1 + len(refcheck_params(self))
+        else:
+            extra = 1
+        for offset,chunk,count,params in backend().query_chunks(bboxes, extra):
+            if self.engine == ENGINE_RTREE:
+                for item in Item.objects.raw(rtree_many_sql(count, self), params):
+                    item.query_index += offset
+                    results.append(item)
+                continue
+            params.append(self.root_id)
+            if self.engine == ENGINE_PACKED:
+                cursor = connection.cursor()
+                cursor.execute(intersect_many_sql(count, packed=True), params)
+                found = {}
+                for qid,payload in cursor:
+                    for item in filter_payload(bytes(payload), chunk[qid]):
+                        item.query_index = offset + qid
+                        found[qid, item.pk] = item
+                results.extend(found.values())
+                continue
+            if unique:
+                params.extend(refcheck_params(self))
+            for item in Item.objects.raw(intersect_many_sql(count, unique=unique), params):
+                item.query_index += offset
+                results.append(item)
+        return results
+
+    def rtree_table(self):
+        # the name of the R*Tree virtual table of an rtree engine tree
+        return '{}_rtree_{}'.format(self._meta.db_table, self.pk)
+
+    def create_rtree(self):
+        # the virtual table only exists on SQLite builds with the R*Tree module
+        # it stores single precision bboxes rounded outwards, so every query also tests the exact bboxes of the items
+        if connection.vendor != 'sqlite':
+            raise ValueError('The rtree engine needs SQLite, not {}'.format(connection.vendor))
+        try:
+            connection.cursor().execute(rtree_sql(RTREE_CREATE_SQL, self))
+        except OperationalError as err:
+            raise ValueError('The rtree engine needs the SQLite R*Tree module: {}'.format(err))
+
+    def rtree_add(self, items):
+        # index saved Item instances in the virtual table
+        connection.cursor().executemany(rtree_sql(RTREE_INSERT_SQL, self),
+                                        [(item.pk, item.xmin, item.xmax, item.ymin, item.ymax) for item in items])
+
+    def rtree_remove_many(self, items):
+        # remove_many for rtree trees, the items are found through the virtual table
+        cursor = connection.cursor()
+        findsql = rtree_sql(RTREE_FIND_SQL, self)
+        removed = set()
+        with transaction.atomic():
+            for item_id,(x1,y1,x2,y2) in items:
+                cursor.execute(findsql, [x1, x2, y1, y2, item_id, x1, y1, x2, y2])
+                removed.update(pk for pk, in cursor.fetchall())
+            pks = [(pk,) for pk in removed]
+            cursor.executemany(rtree_sql(RTREE_DELETE_SQL, self), pks)
+            cursor.executemany(DELETE_ITEM_SQL, pks)
+        return len(removed)
+
+    def drop_rtree(self):
+        # delete the items of an rtree engine tree along with its virtual table
+        cursor = connection.cursor()
+        cursor.execute(rtree_sql(RTREE_DELETE_ITEMS_SQL, self))
+        cursor.execute(rtree_sql(RTREE_DROP_SQL, self))
+
+def create_quadtree_rtree(sender, instance, created=False, raw=False, **kwargs):
+    # a new rtree engine tree gets its virtual table right away, so that inserts don't have to check for it
+    if created and not raw and instance.engine == ENGINE_RTREE:
+        instance.create_rtree()
+
+signals.post_save.connect(create_quadtree_rtree, sender=QuadTree)
+
+def drop_quadtree_rtree(sender, instance, **kwargs):
+    # deleting an rtree engine tree drops its virtual table, node trees go with their rows
+    if instance.engine == ENGINE_RTREE and connection.vendor == 'sqlite':
+        instance.drop_rtree()
+
+signals.post_delete.connect(drop_quadtree_rtree, sender=QuadTree)
+
+class QuadTreeItemField(models.IntegerField):
+    # an integer field holding quadtree item_ids, which can be filtered with the intersects lookup
+    pass
+
+class QuadTreeItem(models.Transform):
+    # the quadtree transform of integer fields, so only they and QuadTreeItemFields get the intersects lookup, eg
+    # Place.objects.filter(pk__quadtree__intersects=(tree, bbox)).filter(population__gt=1000).order_by('name')[:10]
+    # registered on integer fields by the app config
+    lookup_name = 'quadtree'
+    template = '%(expressions)s'
+
+    @property
+    def output_field(self):
+        return QuadTreeItemField()
+
+class QuadTreeIntersects(models.Lookup):
+    # filters any model by the items of a quadtree whose item_id is the given field
+    # the traversal becomes a subquery of the model's own statement, so everything runs as one query
+    # packed trees can't be used, see QuadTree.intersect_subquery
+    lookup_name = 'intersects'
+    prepare_rhs = False
+
+    def as_sql(self, compiler, connection):
+        lhs,lhs_params = self.process_lhs(compiler, connection)
+        tree,bbox = self.rhs
+        sql,params = tree.intersect_subquery(bbox)
+        return '{} IN ({})'.format(lhs, sql), list(lhs_params) + list(params)
+
+QuadTreeItemField.register_lookup(QuadTreeIntersects)
+
+class QuadTreeBinding(object):
+    # keeps a quadtree in sync with the instances of a model, as items with the pk as item_id and the bbox of the given fields
+    # saves and deletes are collected per transaction and applied with one remove_many and insert_many on commit,
+    # one per savepoint they were made in, outside of a transaction they are applied right away
+    # bulk_create() and update() send no signals, so the tree does not see those changes
+
+    def __init__(self, model, tree, fields=('xmin', 'ymin', 'xmax', 'ymax')):
+        self.model = model
+        self.treeid = tree.pk if isinstance(tree, QuadTree) else tree
+        self.fields = tuple(fields)
+        self.attr = '_quadtree_bbox_{}'.format(self.treeid) # the bbox the tree has for an instance
+        self.local = threading.local()
+        self.uid = 'quadtree_binding_{}'.format(id(self))
+        signals.post_init.connect(self.post_init, sender=model, weak=False, dispatch_uid=self.uid)
+        signals.pre_save.connect(self.pre_save, sender=model, weak=False, dispatch_uid=self.uid)
+        signals.post_save.connect(self.post_save, sender=model, weak=False, dispatch_uid=self.uid)
+        signals.post_delete.connect(self.post_delete, sender=model, weak=False, dispatch_uid=self.uid)
+
+    def disconnect(self):
+        for signal in (signals.post_init, signals.pre_save, signals.post_save, signals.post_delete):
+            signal.disconnect(sender=self.model, dispatch_uid=self.uid)
+
+    def bbox(self, instance):
+        # instances without a complete bbox are not indexed
+        bbox = tuple(getattr(instance, field) for field in self.fields)
+        return None if None in bbox else bbox
+
+    def post_init(self, sender, instance, **kwargs):
+        if instance.pk is not None and not instance.get_deferred_fields().intersection(self.fields):
+            setattr(instance, self.attr, self.bbox(instance))
+
+    def pre_save(self, sender, instance, raw=False, **kwargs):
+        # instances loaded with deferred bbox fields get their stored bbox now
+        if raw or instance._state.adding or hasattr(instance, self.attr):
+            return
+        stored = sender._base_manager.filter(pk=instance.pk).values_list(*self.fields).first()
+        setattr(instance, self.attr, None if stored is None or None in stored else tuple(stored))
+
+    def post_save(self, sender, instance, created=False, raw=False, **kwargs):
+        if raw:
+            return
+        old = None if created else getattr(instance, self.attr, None)
+        new = self.bbox(instance)
+        setattr(instance, self.attr, new)
+        self.change(instance.pk, old, new)
+
+    def post_delete(self, sender, instance, **kwargs):
+        self.change(instance.pk, getattr(instance, self.attr, None), None)
+
+    def change(self, pk, old, new):
+        if not connection.in_atomic_block:
+            self.flush([(pk, old, new)])
+            return
+        # changes made under the same savepoints are committed or rolled back together, so they are collected in one run,
+        # applied by the commit callback of its last change, the callbacks of rolled back savepoints never run
+        key = tuple(connection.savepoint_ids)
+        run = getattr(self.local, 'run', None)
+        if run is None or run['key'] != key or run['done']:
+            run = {'key': key, 'changes': [], 'committed': [], 'done': False}
+            self.local.run = run
+        index = len(run['changes'])
+        run['changes'].append((pk, old, new))
+        transaction.on_commit(lambda: self.committed(run, index))
+
+    def committed(self, run, index):
+        run['committed'].append(run['changes'][index])
+        if index == len(run['changes']) - 1:
+            run['done'] = True
+            self.flush(run['committed'])
+
+    def flush(self, changes):
+        batch = {} # pk -> (bbox in the tree, new bbox)
+        for pk,old,new in changes:
+            if pk in batch:
+                old = batch[pk][0]
+            batch[pk] = (old, new)
+        removes = [(pk, old) for pk,(old,new) in batch.items() if old is not None and old != new]
+        inserts = [(pk, new) for pk,(old,new) in batch.items() if new is not None and old != new]
+        if removes or inserts:
+            tree = QuadTree.objects.get(pk=self.treeid)
+            tree.remove_many(removes)
+            if tree.root_id is None:
+                # a tree that was never built, such as during an initial import, is built in bulk
+                tree.bulk_build(inserts)
+            else:
+                tree.insert_many(inserts)
+
 class Item(models.Model):
     item_id = models.IntegerField() # this is the supplied item id/object, and may or may not be unique
-    xmin = models.FloatField()
+    xmin = models.FloatField(db_column='x_min')
     ymin = models.FloatField()
-    xmax = models.FloatField()
+    xmax = models.FloatField(db_column='x_max')
     ymax = models.FloatField()
     #nodes = models.ManyToManyField('Node', related_name='items')
 
@@ -150,10 +1544,16 @@ class Node(models.Model):
     parent = models.ForeignKey('Node', on_delete=models.CASCADE, related_name='child_nodes', db_index=True, null=True, blank=True)
     depth = models.IntegerField()
     item_count = models.IntegerField(default=0, null=True, blank=True) # None means branch, 0 means isleaf (default when creating new node)
-    xmin = models.FloatField()
+    xmin = models.FloatField(db_column='x_min')
     ymin = models.FloatField()
-    xmax = models.FloatField()
+    xmax = models.FloatField(db_column='x_max')
     ymax = models.FloatField()
+    code = models.BigIntegerField(null=True, blank=True) # linear quadtree code, only set for linear engine trees
+    payload = models.BinaryField(null=True, blank=True) # packed items, only used by packed engine trees
+    subtree_count = models.IntegerField(default=0) # items whose lower left corner the node owns, summed over its subtree
+
+    class Meta:
+        indexes = [models.Index(fields=['index', 'code'])]
 
     def __init__(self, *args, **kwargs):
         super(Node, self).__init__(*args, **kwargs)
@@ -170,44 +1570,30 @@ class Node(models.Model):
     def subnodes(self):
         #return self.child_nodes.all().order_by('ymin', 'xmin')
         #return Node.objects.filter(parent=self.pk).order_by('ymin', 'xmin')
-        res = connection.cursor().execute('''
-                                            select id,index_id,parent_id,depth,item_count,xmin,ymin,xmax,ymax
-                                            from {table}
-                                            where parent_id = {nodeid}
-                                            order by ymin,xmin
-                                        '''.format(table=Node._meta.db_table, nodeid=self.pk),
-                                          )
-        res = [Node(*row) for row in res]
+        cursor = connection.cursor()
+        cursor.execute(SUBNODES_SQL, [self.pk])
+        res = [Node(*row) for row in cursor]
+        session = active_session(self.index_id)
+        if session is not None:
+            for node in res:
+                node.item_count = session.count(node)
         return res
 
     def getlinks(self):
         #itemlinks = self.links.all() 
         #itemlinks = ItemNodeLink.objects.filter(node=self)
-        res = connection.cursor().execute('''
-                                            select id,node_id,item_id
-                                            from {table}
-                                            where node_id = {nodeid}
-                                        '''.format(table=ItemNodeLink._meta.db_table, nodeid=self.pk),
-                                          )
-        itemlinks = [ItemNodeLink(*row) for row in res]
+        cursor = connection.cursor()
+        cursor.execute(GETLINKS_SQL, [self.pk])
+        itemlinks = [ItemNodeLink(*row) for row in cursor]
         return itemlinks
 
     def clearlinks(self):
-        connection.cursor().execute('''
-                                            delete from {table}
-                                            where node_id = {nodeid}
-                                        '''.format(table=ItemNodeLink._meta.db_table, nodeid=self.pk),
-                                          )
+        connection.cursor().execute(CLEARLINKS_SQL, [self.pk])
 
     def getitems(self):
-        res = connection.cursor().execute('''SELECT items.id, items.xmin, items.ymin, items.xmax, items.ymax
-                                            FROM {itemtable} AS items
-                                            INNER JOIN {linktable} AS links
-                                            ON links.node_id = {nodeid}
-                                            AND items.id = links.item_id'''.format(itemtable=Item._meta.db_table,
-                                                                                  linktable=ItemNodeLink._meta.db_table,
-                                                                                  nodeid=self.pk,) )
-        items = [Item(*row) for row in res]
+        cursor = connection.cursor()
+        cursor.execute(GETITEMS_SQL, [self.pk])
+        items = [Item(*row) for row in cursor]
         return items
 
     def is_leaf(self):
@@ -222,25 +1608,43 @@ class Node(models.Model):
 
     def insert(self, item):
         #print 'insert',parent
+        bbox = item.xmin,item.ymin,item.xmax,item.ymax
+        if self.owns(bbox):
+            add_owned(self.index_id, [self.pk])
         
         # if is leaf node (has not yet been subdivided)
         if self.is_leaf():
-            # link item to the node itself
-            self.add_item(item)
-            self.save(update_fields=['item_count'])
+            if self.index.engine == ENGINE_PACKED:
+                self.pack_item(item)
+            else:
+                # link item to the node itself
+                self.link_item(item)
+                # increment rather than save our copy of the count, which may be from a cached skeleton,
+                # and go on with the count in the database, which includes the items other processes added since
+                session = active_session(self.index_id)
+                if session is not None:
+                    self.item_count = session.increment(self.pk)
+                else:
+                    self.item_count = backend().add_count(self.pk, 1)
 
             if DEBUG:
                 pass#print 'add to leaf node',self.nodeid
             
-            # test if should split
-            if self.item_count > self.index.max_items and self.depth < self.index.max_depth:
+            # test if should split, unless another process made the node a branch meanwhile
+            if self.item_count is not None and self.index.policy().should_split(self.index, self, self.item_count, self.item_bboxes):
                 self.split()
 
         # elif has subnodes
         else:
             # insert into each overlapping subnode
-            bbox = item.xmin,item.ymin,item.xmax,item.ymax
             quads = self.quadrants(bbox)
+            if len(quads) > 1 and self.index.multilevel:
+                # spanning items stay on the branch
+                if self.index.engine == ENGINE_PACKED:
+                    self.pack_item(item)
+                else:
+                    self.link_item(item)
+                return
             subnodes = list(self.subnodes())
             for quad in quads:
                 node = subnodes[quad-1]
@@ -248,47 +1652,134 @@ class Node(models.Model):
                     pass#print 'recurse into subnode',node.nodeid,node.depth,'---',len(list(node.items())),len(list(node.subnodes()))
                 node.insert(item)
 
+    def item_bboxes(self):
+        # the bboxes of the items stored on the node
+        if self.index.engine == ENGINE_PACKED:
+            return [entry[2:] for entry in struct_iter(PAYLOAD_FORMAT, self.getpayload())]
+        return [item_bbox(item) for item in self.getitems()]
+
     def quadrants(self, bbox):
         # test which quadrant(s) a bbox belongs to
-        quads = []
-        if bbox[0] <= self.center[0]:
-            if bbox[1] <= self.center[1]:
-                quads.append(1)
-            if bbox[3] >= self.center[1]:
-                quads.append(3)
-        if bbox[2] > self.center[0]:
-            if bbox[1] <= self.center[1]:
-                quads.append(2)
-            if bbox[3] >= self.center[1]:
-                quads.append(4)
-        return quads
+        return quadrants(self.center, bbox)
+
+    def owns(self, bbox):
+        # whether the node owns the lower left corner of the bbox
+        return owns_corner((self.xmin,self.ymin,self.xmax,self.ymax), self.index.bounds(), bbox)
+
+    def owned_count(self, items):
+        # the number of Item instances whose lower left corner the node owns
+        return sum(1 for item in items if self.owns(item_bbox(item)))
+
+    def quadrant_bounds(self):
+        # the bboxes of quadrants 1-4, meeting exactly at the center used by quadrants()
+        # so that the node bounds agree with where items were placed
+        cx,cy = self.center
+        return [(self.xmin, self.ymin, cx, cy),
+                (cx, self.ymin, self.xmax, cy),
+                (self.xmin, cy, cx, self.ymax),
+                (cx, cy, self.xmax, self.ymax)]
+
+    def child_code(self, quad):
+        # the linear quadtree code of one of the node's quadrants (1-4)
+        if self.code is None:
+            return None
+        prefix = self.code >> LINEAR_DEPTH_BITS
+        prefix += (quad-1) * 4 ** (LINEAR_LEVELS - self.depth - 1)
+        return (prefix << LINEAR_DEPTH_BITS) + self.depth + 1
 
     def split(self):
         #print('split')
-        quartwidth = self.halfwidth/2.0
-        quartheight = self.halfheight/2.0
-        x1 = self.center[0] - quartwidth
-        x2 = self.center[0] + quartwidth
-        y1 = self.center[1] - quartheight
-        y2 = self.center[1] + quartheight
-
         # create 4 new subnodes
         parent = self
         new_depth = self.depth + 1
         count = 0
-        subnodes = [Node.objects.create(index=self.index, parent=parent, depth=new_depth, item_count=count, xmin=x1-quartwidth, ymin=y1-quartheight, xmax=x1+quartwidth, ymax=y1+quartheight),
-                     Node.objects.create(index=self.index, parent=parent, depth=new_depth, item_count=count, xmin=x2-quartwidth, ymin=y1-quartheight, xmax=x2+quartwidth, ymax=y1+quartheight),
-                     Node.objects.create(index=self.index, parent=parent, depth=new_depth, item_count=count, xmin=x1-quartwidth, ymin=y2-quartheight, xmax=x1+quartwidth, ymax=y2+quartheight),
-                     Node.objects.create(index=self.index, parent=parent, depth=new_depth, item_count=count, xmin=x2-quartwidth, ymin=y2-quartheight, xmax=x2+quartwidth, ymax=y2+quartheight)]
+        subnodes = [Node.objects.create(index=self.index, parent=parent, depth=new_depth, item_count=count, code=self.child_code(quad), xmin=x1, ymin=y1, xmax=x2, ymax=y2)
+                    for quad,(x1,y1,x2,y2) in enumerate(self.quadrant_bounds(), 1)]
         #Node.objects.bulk_create(subnodes)
         #for node in subnodes:
         #    node.save()
+        skeleton = cached_skeletons().get(self.index_id)
+        version = bump_version(self.index_id, skeleton.version if skeleton is not None else None)
 
 ##        if DEBUG:
 ##            print 'split',self.nodeid
 ##            for node in subnodes:
 ##                passprint 'quad',node.nodeid, node.parent, node.depth
 
+        # move the items down to the new subnodes and make this node a branch
+        session = active_session(self.index_id)
+        if session is not None:
+            session.discard(self.pk)
+        if self.index.engine == ENGINE_PACKED:
+            self.split_packed(subnodes)
+        else:
+            self.split_links(subnodes)
+
+        # keep a cached skeleton of the tree in sync
+        if skeleton is not None:
+            skeleton.split(self, subnodes, version)
+
+        # ONE-BY-ONE SLOW: update items so they link to the new subnodes
+##        for item in items:
+##            #print('adding into subquads',item)
+##            bbox = item.xmin,item.ymin,item.xmax,item.ymax
+##            quads = self.quadrants(bbox)
+##            for quad in quads:
+##                newnode = subnodes[quad-1]
+##                newnode.add_item(item)
+##        #Node.objects.bulk_update(subnodes)
+##        for node in subnodes:
+##            node.save(update_fields=['item_count'])
+
+    # In-memory (bulk) versions of insert and split
+
+    def init_memory(self, parent):
+        self._mem_parent = parent
+        self._mem_children = []
+        self._mem_items = []
+
+    def memory_insert(self, item, allnodes):
+        bbox = item.xmin,item.ymin,item.xmax,item.ymax
+        if self.owns(bbox):
+            self.subtree_count += 1
+        if self.is_leaf():
+            self._mem_items.append(item)
+            self.item_count += 1
+            if self.index.policy().should_split(self.index, self, self.item_count, lambda: list(map(item_bbox, self._mem_items))):
+                self.memory_split(allnodes)
+        else:
+            quads = self.quadrants(bbox)
+            if len(quads) > 1 and self.index.multilevel:
+                self._mem_items.append(item)
+                return
+            for quad in quads:
+                self._mem_children[quad-1].memory_insert(item, allnodes)
+
+    def memory_split(self, allnodes):
+        new_depth = self.depth + 1
+        subnodes = [Node(index=self.index, depth=new_depth, item_count=0, code=self.child_code(quad), xmin=x1, ymin=y1, xmax=x2, ymax=y2)
+                    for quad,(x1,y1,x2,y2) in enumerate(self.quadrant_bounds(), 1)]
+        for node in subnodes:
+            node.init_memory(self)
+        allnodes.extend(subnodes)
+        self._mem_children = subnodes
+
+        # move items down to the new subnodes
+        items = self._mem_items
+        self._mem_items = []
+        self.item_count = None
+        if self.index.multilevel:
+            items,self._mem_items = partition_spanning(self.center, items)
+        for quad,quaditems in group_quadrants(self.center, items).items():
+            node = subnodes[quad-1]
+            node._mem_items.extend(quaditems)
+            node.item_count += len(quaditems)
+            node.subtree_count += node.owned_count(quaditems)
+
+    def link_item(self, item):
+        connection.cursor().execute(ADDITEM_SQL, [item.pk, self.pk])
+
+    def split_links(self, subnodes):
         # delete previous links to this node and reset node count
         #itemlinks = ItemNodeLink.objects.filter(node=self)
         #itemlinks = self.links.all()
@@ -303,16 +1794,14 @@ class Node(models.Model):
         self.save(update_fields=['item_count'])
 
         # BULK: update items so they link to the new subnodes
+        newlinks = []
+        if self.index.multilevel:
+            # items spanning several subnodes stay linked to this node
+            items,spanning = partition_spanning(self.center, items)
+            newlinks += [ItemNodeLink(item=item, node=self) for item in spanning]
         # group items by quad/subnode
-        quaditems = {1:[], 2:[], 3:[], 4:[]}
-        for item in items:
-            #print('adding into subquads',item)
-            bbox = item.xmin,item.ymin,item.xmax,item.ymax
-            quads = self.quadrants(bbox)
-            for quad in quads:
-                quaditems[quad].append(item)
+        quaditems = group_quadrants(self.center, items)
         # for each quad/subnode, bulk insert new links and update count
-        newlinks = []
         for quad,quaditems in quaditems.items():
             #print('link to new subnodes',quad,len(quaditems))
             newnode = subnodes[quad-1]
@@ -320,37 +1809,881 @@ class Node(models.Model):
             #ItemNodeLink.objects.bulk_create(newlinks)
             #ItemNodeLink.raw_bulk_create(newnode, quaditems)
             newnode.item_count = len(quaditems)
-            newnode.save(update_fields=['item_count'])
+            newnode.subtree_count = newnode.owned_count(quaditems)
+            newnode.save(update_fields=['item_count', 'subtree_count'])
         ItemNodeLink.objects.bulk_create(newlinks)
 
-        # ONE-BY-ONE SLOW: update items so they link to the new subnodes
-##        for item in items:
-##            #print('adding into subquads',item)
-##            bbox = item.xmin,item.ymin,item.xmax,item.ymax
-##            quads = self.quadrants(bbox)
-##            for quad in quads:
-##                newnode = subnodes[quad-1]
-##                newnode.add_item(item)
-##        #Node.objects.bulk_update(subnodes)
-##        for node in subnodes:
-##            node.save(update_fields=['item_count'])
+    def split_packed(self, subnodes):
+        # divide the packed items between the new subnodes
+        stay,payloads = split_payload(self.center, self.getpayload(), self.index.multilevel)
+        self.item_count = None
+        self.payload = stay or None
+        self.save(update_fields=['item_count', 'payload'])
+        for newnode,payload in zip(subnodes, payloads):
+            newnode.payload = payload
+            newnode.item_count = len(payload) // PAYLOAD_SIZE
+            newnode.subtree_count = newnode.owned_count(unpack_payload(payload))
+            newnode.save(update_fields=['item_count', 'payload', 'subtree_count'])
+
+    def getpayload(self):
+        cursor = connection.cursor()
+        cursor.execute(GETPAYLOAD_SQL, [self.pk])
+        payload = cursor.fetchone()[0]
+        return bytes(payload) if payload is not None else b''
+
+    def pack_item(self, item):
+        # append the item to the node's packed payload in the database, without reading the payload back
+        self.item_count = backend().append_payload(self.pk, pack_payload([item]))
+
+
+
+# In-memory node skeleton
+
+_skeletons = threading.local()
+
+def cached_skeletons():
+    # skeletons are cached per thread, keyed by tree id
+    if not hasattr(_skeletons, 'trees'):
+        _skeletons.trees = {}
+    return _skeletons.trees
+
+class NodeSkeleton(object):
+    # compact copy of a tree's node structure, for descending inserts without querying the database
+    # nodes are stored by slot in flat arrays, the four subnodes of a branch occupy consecutive slots
+    # counts are only the local view, used for split decisions, the database count is always incremented
+
+    def __init__(self, tree, version):
+        self.tree = tree
+        self.version = version
+        self.slots = {} # node id -> slot
+        self.ids = array('l')
+        self.parents = array('l') # parent slot, -1 for root
+        self.depths = array('l')
+        self.counts = array('l')
+        self.codes = [] # may be None
+        self.bounds = array('d') # xmin,ymin,xmax,ymax for each slot
+        self.centers = array('d') # x,y for each slot
+        self.children = array('l') # slot of the first subnode, -1 for leaves
+
+        cursor = connection.cursor()
+        cursor.execute(SKELETON_SQL, [tree.pk])
+        for nodeid,parentid,depth,count,xmin,ymin,xmax,ymax,code in cursor:
+            # only the nodes below the root, not those left behind by an interrupted split
+            if nodeid == tree.root_id:
+                parent = -1
+            elif parentid in self.slots:
+                parent = self.slots[parentid]
+            else:
+                continue
+            slot = self.add(nodeid, parent, depth, count, (xmin,ymin,xmax,ymax), code)
+            if parent >= 0 and self.children[parent] < 0:
+                self.children[parent] = slot
+
+    def add(self, nodeid, parent, depth, count, bbox, code):
+        slot = len(self.ids)
+        self.slots[nodeid] = slot
+        self.ids.append(nodeid)
+        self.parents.append(parent)
+        self.depths.append(depth)
+        self.counts.append(count if count is not None else -1)
+        self.codes.append(code)
+        self.bounds.extend(bbox)
+        # same arithmetic as Node.__init__, so quadrants are decided identically
+        xmin,ymin,xmax,ymax = bbox
+        self.centers.append(xmin + (xmax - xmin) / 2.0)
+        self.centers.append(ymin + (ymax - ymin) / 2.0)
+        self.children.append(-1)
+        return slot
+
+    def node(self, slot):
+        # a Node instance for the slot, without querying the database
+        parent = self.parents[slot]
+        count = self.counts[slot]
+        xmin,ymin,xmax,ymax = self.bounds[slot*4:slot*4+4]
+        return Node(id=self.ids[slot], index=self.tree,
+                    parent_id=self.ids[parent] if parent >= 0 else None,
+                    depth=self.depths[slot], item_count=count if count >= 0 else None,
+                    xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax, code=self.codes[slot])
+
+    def leaves(self, bbox, slot=0):
+        # the leaf slots an item with the given bbox goes into, in the same order as Node.insert
+        # for multilevel trees this may be the branch where the item spans several subnodes
+        first = self.children[slot]
+        if first < 0:
+            return [slot]
+        center = self.centers[slot*2], self.centers[slot*2+1]
+        quads = quadrants(center, bbox)
+        if len(quads) > 1 and self.tree.multilevel:
+            return [slot]
+        leaves = []
+        for quad in quads:
+            leaves.extend(self.leaves(bbox, first + quad - 1))
+        return leaves
+
+    def owner_path(self, bbox):
+        # the slots from the root down to the node owning the bbox corner, see Node.owns
+        slot = 0
+        path = [slot]
+        while self.children[slot] >= 0:
+            cx,cy = self.centers[slot*2], self.centers[slot*2+1]
+            if self.tree.multilevel and len(quadrants((cx,cy), bbox)) > 1:
+                break
+            quad = (1 if bbox[0] <= cx else 2) + (0 if bbox[1] < cy else 2)
+            slot = self.children[slot] + quad - 1
+            path.append(slot)
+        return path
+
+    def area(self, slot):
+        xmin,ymin,xmax,ymax = self.bounds[slot*4:slot*4+4]
+        return (xmax - xmin) * (ymax - ymin)
+
+    def point_path(self, x, y):
+        # the slots from the root down to the leaf a point falls in,
+        # every item whose bbox contains the point is in that leaf or, for multilevel trees, one of the branches
+        slot = 0
+        path = [slot]
+        while self.children[slot] >= 0:
+            cx,cy = self.centers[slot*2], self.centers[slot*2+1]
+            quad = (1 if x <= cx else 2) + (0 if y < cy else 2)
+            slot = self.children[slot] + quad - 1
+            path.append(slot)
+        return path
+
+    def insert(self, item):
+        bbox = item.xmin,item.ymin,item.xmax,item.ymax
+        # the owning node itself is counted by Node.insert, its ancestors are skipped by the descent
+        ancestors = self.owner_path(bbox)[:-1]
+        if ancestors:
+            add_owned(self.tree.pk, [self.ids[slot] for slot in ancestors])
+        for slot in self.leaves(bbox):
+            node = self.node(slot)
+            node.insert(item)
+            if node.is_leaf():
+                self.counts[slot] = node.item_count
+
+    def split(self, node, subnodes, version):
+        # called by Node.split, with the version token it wrote if the tree was at this skeleton's version
+        slot = self.slots.get(node.pk)
+        if version is None or slot is None or self.children[slot] >= 0:
+            # other processes changed the tree, the skeleton is reloaded when next asked for
+            self.version = None
+            return
+        self.counts[slot] = -1
+        self.children[slot] = len(self.ids)
+        for sub in subnodes:
+            self.add(sub.pk, slot, sub.depth, sub.item_count, (sub.xmin,sub.ymin,sub.xmax,sub.ymax), sub.code)
+        self.version = version
+
+
+
+# Insert sessions
+
+_sessions = threading.local()
+
+def active_session(treeid):
+    # the insert session currently open for a tree in this thread, if any
+    return getattr(_sessions, 'trees', {}).get(treeid)
+
+class InsertSession(object):
+    # runs inserts in one transaction, keeping node count increments in memory
+    # and writing them as one update per touched node when the session ends
+    # nested sessions on the same tree join the outer one
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.deltas = {} # node id -> pending count increment
+        self.counts = {} # node id -> count in the database when the session first incremented it
+        self.owned = {} # node id -> pending subtree_count increment
+        self.atomic = None
+
+    def __enter__(self):
+        if not hasattr(_sessions, 'trees'):
+            _sessions.trees = {}
+        if self.tree.pk not in _sessions.trees:
+            self.atomic = transaction.atomic()
+            self.atomic.__enter__()
+            _sessions.trees[self.tree.pk] = self
+        return _sessions.trees[self.tree.pk]
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.atomic is None:
+            return False
+        del _sessions.trees[self.tree.pk]
+        flusherror = None
+        if exc_type is None:
+            try:
+                self.flush()
+            except Exception as err:
+                flusherror = err
+                exc_type, exc_value, traceback = sys.exc_info()
+        if exc_type is not None:
+            # the skeleton may hold nodes that are being rolled back
+            self.tree.forget_skeleton()
+        self.atomic.__exit__(exc_type, exc_value, traceback)
+        if flusherror is not None:
+            raise flusherror
+        return False
+
+    def increment(self, nodeid):
+        # returns the node's count including this item, see Backend.read_count
+        if nodeid not in self.counts:
+            self.counts[nodeid] = backend().read_count(nodeid)
+        self.deltas[nodeid] = self.deltas.get(nodeid, 0) + 1
+        if self.counts[nodeid] is None:
+            return None
+        return self.counts[nodeid] + self.deltas[nodeid]
+
+    def own(self, nodeids):
+        for nodeid in nodeids:
+            self.owned[nodeid] = self.owned.get(nodeid, 0) + 1
+
+    def discard(self, nodeid):
+        # the node was split, its count is no longer kept
+        self.deltas.pop(nodeid, None)
+        self.counts.pop(nodeid, None)
+
+    def count(self, node):
+        # the node's current count, given its count as stored in the database
+        if node.item_count is None:
+            return None
+        return node.item_count + self.deltas.get(node.pk, 0)
+
+    def flush(self):
+        if self.deltas:
+            params = [(delta, nodeid) for nodeid,delta in self.deltas.items()]
+            connection.cursor().executemany(ADD_COUNT_SQL, params)
+            self.deltas = {}
+            self.counts = {}
+        if self.owned:
+            params = [(delta, nodeid) for nodeid,delta in self.owned.items()]
+            connection.cursor().executemany(ADD_SUBTREE_SQL, params)
+            self.owned = {}
+
+
+
+# Fixed SQL statements
+# table names are filled in once, values are always passed as query parameters,
+# so every query of the same shape has identical text and its plan can be reused
+
+def bounds_params(bbox):
+    # parameters for one BOUNDSCHECK
+    x1,y1,x2,y2 = bbox
+    return [x1, x2, y1, y2]
+
+BOUNDSCHECK = '(%s < x_max AND %s > x_min) AND (%s < ymax AND %s > ymin)'
+
+TABLE_BOUNDSCHECK = '(%s < {table}.x_max AND %s > {table}.x_min) AND (%s < {table}.ymax AND %s > {table}.ymin)'
+
+QUERIES_BOUNDSCHECK = '(queries.qxmin < {table}.x_max AND queries.qxmax > {table}.x_min) AND (queries.qymin < {table}.ymax AND queries.qymax > {table}.ymin)'
 
-    def add_item(self, item):
-        # add link
-        #self.items.add(item)
-        #ItemNodeLink.objects.create(item=item, node=self)
-        #ItemNodeLink.raw_create(item, self)
-        res = connection.cursor().execute('''
-                                            insert into {table} (item_id, node_id)
-                                            values (%s, %s)
-                                        '''.format(table=ItemNodeLink._meta.db_table),
-                                          (item.pk, self.pk),
+# An item linked into several leaves is only reported from the leaf owning the lower left corner of
+# its overlap with the query, so results come back unique without a DISTINCT over all rows.
+# Leaves own x in (xmin, xmax] and y in [ymin, ymax), matching the <= and > tests of quadrants(),
+# and leaves on the tree edges also own everything beyond them.
+# Branch nodes only hold multilevel items, which are stored once, so they always report.
+REFCHECK = '''({node}.item_count IS NULL OR
+                    ((({item}.x_min > {qx} AND ({item}.x_min > {node}.x_min OR {node}.x_min <= %s) AND ({item}.x_min <= {node}.x_max OR {node}.x_max >= %s))
+                      OR ({item}.x_min <= {qx} AND ({qx} >= {node}.x_min OR {node}.x_min <= %s)))
+                     AND ({item}.ymin >= {node}.ymin OR {qy} >= {node}.ymin OR {node}.ymin <= %s)
+                     AND ({item}.ymin < {node}.ymax OR {node}.ymax >= %s)))'''
+
+def refcheck_params(tree, bbox=None):
+    # parameters for one REFCHECK, including the query corner if it is passed as parameters
+    if bbox is None:
+        return [tree.xmin, tree.xmax, tree.xmin, tree.ymin, tree.ymax]
+    x1,y1 = bbox[0],bbox[1]
+    return [x1, tree.xmin, tree.xmax, x1, x1, tree.xmin, y1, tree.ymin, tree.ymax]
+
+# Nodes strictly inside the query. Every item linked into them intersects the query,
+# and every item whose corner they own reports from inside them.
+# Nodes on the tree edges may hold items beyond the tree, so they never qualify.
+CONTAINCHECK = '''(%s < {table}.x_min AND %s < {table}.x_min AND {table}.x_max < %s AND {table}.x_max < %s
+                    AND %s < {table}.ymin AND %s < {table}.ymin AND {table}.ymax < %s AND {table}.ymax < %s)'''
+
+def containcheck_params(tree, bbox):
+    # parameters for one CONTAINCHECK
+    x1,y1,x2,y2 = bbox
+    return [x1, tree.xmin, x2, tree.xmax, y1, tree.ymin, y2, tree.ymax]
+
+def intersect_params(tree, bbox):
+    # parameters for INTERSECT_ALL_SQL, INTERSECT_SQL adds refcheck_params(tree, bbox)
+    boundsparams = bounds_params(bbox)
+    containparams = containcheck_params(tree, bbox)
+    return containparams + [tree.root_id] + boundsparams + containparams + boundsparams + boundsparams
+
+# Walks down from the root through the indexed parent ids.
+# Once a node is contained, its whole subtree is contained,
+# so the traversal stops testing node bounds below it and its items skip the bounds test.
+INTERSECT_TRAVERSAL = '''
+                WITH RECURSIVE traversal AS
+                  (SELECT id AS nodeid, CASE WHEN {rootcontained} THEN 1 ELSE 0 END AS contained
+                   FROM {nodes_table}
+                   WHERE id = %s AND {boundscheck}
+
+                   UNION ALL
+
+                   SELECT nodes.id AS nodeid, CASE WHEN traversal.contained = 1 OR {contained} THEN 1 ELSE 0 END AS contained
+                   FROM traversal
+                   CROSS JOIN {nodes_table} AS nodes
+                   WHERE nodes.parent_id = traversal.nodeid AND (traversal.contained = 1 OR {nodecheck})
+                   )'''.format(rootcontained=CONTAINCHECK.format(table=Node._meta.db_table),
+                               contained=CONTAINCHECK.format(table='nodes'),
+                               boundscheck=BOUNDSCHECK,
+                               nodecheck=TABLE_BOUNDSCHECK.format(table='nodes'),
+                               nodes_table=Node._meta.db_table,
+                               )
+
+INTERSECT_TEMPLATE = INTERSECT_TRAVERSAL + ''',
+                travlinks AS
+                    (SELECT links.item_id,links.node_id,traversal.contained
+                    FROM traversal CROSS JOIN {links_table} AS links
+                    WHERE links.node_id = traversal.nodeid)
+
+               -- Extract
+               SELECT items.id AS id, items.item_id, items.x_min, items.ymin, items.x_max, items.ymax
+               FROM travlinks
+               CROSS JOIN {items_table} AS items
+               {extract}
+                '''
+
+# each item once, params are intersect_params(tree, bbox) + refcheck_params(tree, bbox)
+INTERSECT_SQL = INTERSECT_TEMPLATE.format(items_table=Item._meta.db_table,
+                                          links_table=ItemNodeLink._meta.db_table,
+                                          extract='''INNER JOIN {nodes_table} AS leaf ON leaf.id = travlinks.node_id
+               WHERE items.id = travlinks.item_id AND (travlinks.contained = 1 OR {itemcheck}) AND {refcheck}'''.format(nodes_table=Node._meta.db_table,
+                                                          itemcheck=TABLE_BOUNDSCHECK.format(table='items'),
+                                                          refcheck=REFCHECK.format(node='leaf', item='items', qx='%s', qy='%s')),
                                           )
-        # update count
-        if self.item_count is None:
-            self.item_count = 1 # from 0 to 1
+
+# items once per leaf they are linked into, params are intersect_params(tree, bbox)
+INTERSECT_ALL_SQL = INTERSECT_TEMPLATE.format(items_table=Item._meta.db_table,
+                                              links_table=ItemNodeLink._meta.db_table,
+                                              extract='WHERE items.id = travlinks.item_id AND (travlinks.contained = 1 OR {})'.format(TABLE_BOUNDSCHECK.format(table='items')),
+                                              )
+
+# the item ids of an intersect statement
+SUBQUERY_SQL = '''
+                SELECT quadtree_items.item_id
+                FROM ({sql}) AS quadtree_items
+                '''
+
+# walks down from the root through the indexed parent ids, stopping at nodes inside the query
+# params are containcheck_params(tree, bbox) + [root id] + bounds_params(bbox) + containcheck_params(tree, bbox) + bounds_params(bbox)
+COUNT_TRAVERSAL = '''
+                WITH RECURSIVE traversal AS
+                  (SELECT id AS nodeid, item_count, subtree_count, x_min, ymin, x_max, ymax,
+                          CASE WHEN {rootcontained} THEN 1 ELSE 0 END AS contained
+                   FROM {nodes_table}
+                   WHERE id = %s AND {boundscheck}
+
+                   UNION ALL
+
+                   SELECT nodes.id AS nodeid, nodes.item_count, nodes.subtree_count, nodes.x_min, nodes.ymin, nodes.x_max, nodes.ymax,
+                          CASE WHEN {contained} THEN 1 ELSE 0 END AS contained
+                   FROM traversal
+                   CROSS JOIN {nodes_table} AS nodes
+                   WHERE nodes.parent_id = traversal.nodeid AND traversal.contained = 0 AND {nodecheck}
+                   )
+                '''.format(rootcontained=CONTAINCHECK.format(table=Node._meta.db_table),
+                           contained=CONTAINCHECK.format(table='nodes'),
+                           boundscheck=BOUNDSCHECK,
+                           nodecheck=TABLE_BOUNDSCHECK.format(table='nodes'),
+                           nodes_table=Node._meta.db_table,
+                           )
+
+# the counts from contained subtrees and from the boundary nodes,
+# extra params are bounds_params(bbox) + refcheck_params(tree, bbox)
+COUNT_SQL = COUNT_TRAVERSAL + '''
+               -- Extract
+               SELECT (SELECT COALESCE(SUM(subtree_count), 0) FROM traversal WHERE contained = 1),
+                      (SELECT COUNT(*)
+                       FROM traversal
+                       CROSS JOIN {links_table} AS links
+                       CROSS JOIN {items_table} AS items
+                       WHERE traversal.contained = 0 AND links.node_id = traversal.nodeid AND items.id = links.item_id
+                       AND {itemcheck} AND {refcheck})
+                '''.format(itemcheck=TABLE_BOUNDSCHECK.format(table='items'),
+                           refcheck=REFCHECK.format(node='traversal', item='items', qx='%s', qy='%s'),
+                           items_table=Item._meta.db_table,
+                           links_table=ItemNodeLink._meta.db_table,
+                           )
+
+PACKED_COUNT_SQL = COUNT_TRAVERSAL + '''
+               -- Extract
+               SELECT traversal.contained, traversal.subtree_count, traversal.item_count,
+                      traversal.x_min, traversal.ymin, traversal.x_max, traversal.ymax,
+                      CASE WHEN traversal.contained = 0 THEN nodes.payload END
+               FROM traversal
+               INNER JOIN {nodes_table} AS nodes ON nodes.id = traversal.nodeid
+                '''.format(nodes_table=Node._meta.db_table)
+
+# params are intersect_params(tree, bbox)[:-4], items are filtered in python
+PACKED_INTERSECT_SQL = INTERSECT_TRAVERSAL + '''
+
+               -- Extract
+               SELECT traversal.contained, nodes.payload
+               FROM traversal
+               INNER JOIN {nodes_table} AS nodes ON nodes.id = traversal.nodeid
+               WHERE nodes.payload IS NOT NULL
+                '''.format(nodes_table=Node._meta.db_table)
+
+SUBNODES_SQL = '''
+                select id,index_id,parent_id,depth,item_count,x_min,ymin,x_max,ymax,code
+                from {table}
+                where parent_id = %s
+                order by ymin,x_min
+                '''.format(table=Node._meta.db_table)
+
+SKELETON_SQL = '''
+                select id,parent_id,depth,item_count,x_min,ymin,x_max,ymax,code
+                from {table}
+                where index_id = %s
+                order by depth,parent_id,ymin,x_min
+                '''.format(table=Node._meta.db_table)
+
+VERSION_SQL = '''
+                select version
+                from {table}
+                where id = %s
+                '''.format(table=QuadTree._meta.db_table)
+
+BUMP_VERSION_SQL = '''
+                update {table}
+                set version = %s
+                where id = %s
+                '''.format(table=QuadTree._meta.db_table)
+
+SWAP_VERSION_SQL = '''
+                update {table}
+                set version = %s
+                where id = %s and version = %s
+                '''.format(table=QuadTree._meta.db_table)
+
+GETCOUNT_SQL = '''
+                select item_count
+                from {table}
+                where id = %s
+                '''.format(table=Node._meta.db_table)
+
+ADD_SUBTREE_SQL = '''
+                update {table}
+                set subtree_count = subtree_count + %s
+                where id = %s
+                '''.format(table=Node._meta.db_table)
+
+ADD_COUNT_SQL = '''
+                update {table}
+                set item_count = item_count + %s
+                where id = %s
+                '''.format(table=Node._meta.db_table)
+
+GETPAYLOAD_SQL = '''
+                select payload
+                from {table}
+                where id = %s
+                '''.format(table=Node._meta.db_table)
+
+SETPAYLOAD_SQL = '''
+                update {table}
+                set payload = %s, item_count = %s
+                where id = %s
+                '''.format(table=Node._meta.db_table)
+
+# branches have no count, null + n stays null
+APPEND_PAYLOAD_SQL = '''
+                update {table}
+                set payload = cast(coalesce(payload, X'') || %s as blob), item_count = item_count + %s
+                where id = %s
+                '''.format(table=Node._meta.db_table)
+
+NEAREST_ROOT_SQL = '''
+                select id,item_count,x_min,ymin,x_max,ymax
+                from {table}
+                where id = %s
+                '''.format(table=Node._meta.db_table)
+
+NEAREST_CHILDREN_SQL = '''
+                select id,item_count,x_min,ymin,x_max,ymax
+                from {table}
+                where parent_id = %s
+                '''.format(table=Node._meta.db_table)
+
+GETLINKS_SQL = '''
+                select id,node_id,item_id
+                from {table}
+                where node_id = %s
+                '''.format(table=ItemNodeLink._meta.db_table)
+
+CLEARLINKS_SQL = '''
+                delete from {table}
+                where node_id = %s
+                '''.format(table=ItemNodeLink._meta.db_table)
+
+DELETE_NODE_SQL = '''
+                delete from {table}
+                where id = %s
+                '''.format(table=Node._meta.db_table)
+
+MOVE_SUBNODES_SQL = '''
+                update {table}
+                set parent_id = %s
+                where parent_id = %s
+                '''.format(table=Node._meta.db_table)
+
+COPY_LINKS_SQL = '''
+                insert into {table} (item_id, node_id)
+                select item_id, %s
+                from {table}
+                where node_id = %s
+                order by id
+                '''.format(table=ItemNodeLink._meta.db_table)
+
+DELETE_ITEM_LINKS_SQL = '''
+                delete from {table}
+                where item_id = %s
+                '''.format(table=ItemNodeLink._meta.db_table)
+
+DELETE_ITEM_SQL = '''
+                delete from {table}
+                where id = %s
+                '''.format(table=Item._meta.db_table)
+
+GETITEMS_SQL = '''
+                SELECT items.id, items.item_id, items.x_min, items.ymin, items.x_max, items.ymax
+                FROM {itemtable} AS items
+                INNER JOIN {linktable} AS links
+                ON links.node_id = %s
+                AND items.id = links.item_id
+                '''.format(itemtable=Item._meta.db_table,
+                           linktable=ItemNodeLink._meta.db_table)
+
+ADDITEM_SQL = '''
+                insert into {table} (item_id, node_id)
+                values (%s, %s)
+                '''.format(table=ItemNodeLink._meta.db_table)
+
+# the rows of a whole tree, see QuadTree.clear
+DELETE_TREE_ITEMS_SQL = '''
+                delete from {itemtable}
+                where id in (select links.item_id
+                             from {linktable} as links
+                             inner join {nodetable} as nodes
+                             on nodes.id = links.node_id
+                             where nodes.index_id = %s)
+                '''.format(itemtable=Item._meta.db_table,
+                           linktable=ItemNodeLink._meta.db_table,
+                           nodetable=Node._meta.db_table)
+
+DELETE_TREE_LINKS_SQL = '''
+                delete from {linktable}
+                where node_id in (select id from {nodetable} where index_id = %s)
+                '''.format(linktable=ItemNodeLink._meta.db_table,
+                           nodetable=Node._meta.db_table)
+
+DELETE_TREE_NODES_SQL = '''
+                delete from {table}
+                where index_id = %s
+                '''.format(table=Node._meta.db_table)
+
+INTERSECT_MANY_SQL = {}
+
+# statements on the virtual table of an rtree engine tree, see rtree_sql
+# the virtual table only narrows down the candidates, the exact bboxes are tested on the items
+RTREE_CREATE_SQL = '''
+                create virtual table if not exists {rtree_table}
+                using rtree(id, x_min, x_max, ymin, ymax)
+                '''
+
+RTREE_INSERT_SQL = '''
+                insert into {rtree_table} (id, x_min, x_max, ymin, ymax)
+                values (%s, %s, %s, %s, %s)
+                '''
+
+RTREE_DELETE_SQL = '''
+                delete from {rtree_table}
+                where id = %s
+                '''
+
+RTREE_DELETE_ITEMS_SQL = '''
+                delete from {items_table}
+                where id in (select id from {rtree_table})
+                '''
+
+RTREE_CLEAR_SQL = '''
+                delete from {rtree_table}
+                '''
+
+RTREE_DROP_SQL = '''
+                drop table if exists {rtree_table}
+                '''
+
+# params are bounds_params(bbox) twice
+RTREE_INTERSECT_SQL = '''
+                SELECT items.id AS id, items.item_id, items.x_min, items.ymin, items.x_max, items.ymax
+                FROM {{rtree_table}} AS rtree
+                CROSS JOIN {{items_table}} AS items
+                WHERE {rtreecheck} AND items.id = rtree.id AND {itemcheck}
+                '''.format(rtreecheck=TABLE_BOUNDSCHECK.format(table='rtree'),
+                           itemcheck=TABLE_BOUNDSCHECK.format(table='items'))
+
+RTREE_COUNT_SQL = '''
+                SELECT COUNT(*)
+                FROM {{rtree_table}} AS rtree
+                CROSS JOIN {{items_table}} AS items
+                WHERE {rtreecheck} AND items.id = rtree.id AND {itemcheck}
+                '''.format(rtreecheck=TABLE_BOUNDSCHECK.format(table='rtree'),
+                           itemcheck=TABLE_BOUNDSCHECK.format(table='items'))
+
+# params are [x, x, y, y] twice, edges included
+RTREE_POINT_SQL = '''
+                SELECT items.id AS id, items.item_id, items.x_min, items.ymin, items.x_max, items.ymax
+                FROM {rtree_table} AS rtree
+                CROSS JOIN {items_table} AS items
+                WHERE rtree.x_min <= %s AND rtree.x_max >= %s AND rtree.ymin <= %s AND rtree.ymax >= %s
+                AND items.id = rtree.id
+                AND items.x_min <= %s AND items.x_max >= %s AND items.ymin <= %s AND items.ymax >= %s
+                '''
+
+# the ids of the items with an item_id and exact bbox, params are [x1, x2, y1, y2, item_id, x1, y1, x2, y2]
+RTREE_FIND_SQL = '''
+                SELECT items.id
+                FROM {rtree_table} AS rtree
+                CROSS JOIN {items_table} AS items
+                WHERE rtree.x_min <= %s AND rtree.x_max >= %s AND rtree.ymin <= %s AND rtree.ymax >= %s
+                AND items.id = rtree.id AND items.item_id = %s
+                AND items.x_min = %s AND items.ymin = %s AND items.x_max = %s AND items.ymax = %s
+                '''
+
+# statements are cached with the table name left to fill in, it is the only part that differs between trees
+RTREE_SQL = {}
+
+def rtree_sql(template, tree):
+    # an RTREE_* statement for the virtual table of a tree, cached per template
+    if template not in RTREE_SQL:
+        RTREE_SQL[template] = template.format(rtree_table='{rtree_table}', items_table=Item._meta.db_table)
+    return RTREE_SQL[template].format(rtree_table=tree.rtree_table())
+
+def rtree_many_sql(count, tree):
+    # the statement for intersecting count bboxes with the virtual table of a tree, cached per count
+    # the rtree constraints come from the joined queries, so each bbox is one index lookup
+    if count not in RTREE_SQL:
+        values = ', '.join('({}, %s, %s, %s, %s)'.format(qid) for qid in range(count))
+        RTREE_SQL[count] = '''
+                WITH queries (qid, qxmin, qymin, qxmax, qymax) AS
+                    (VALUES {values})
+                SELECT items.id AS id, items.item_id, items.x_min, items.ymin, items.x_max, items.ymax, queries.qid AS query_index
+                FROM queries
+                CROSS JOIN {rtree_table} AS rtree
+                CROSS JOIN {items_table} AS items
+                WHERE {rtreecheck} AND items.id = rtree.id AND {itemcheck}
+                '''.format(values=values,
+                           rtreecheck=QUERIES_BOUNDSCHECK.format(table='rtree'),
+                           itemcheck=QUERIES_BOUNDSCHECK.format(table='items'),
+                           rtree_table='{rtree_table}',
+                           items_table=Item._meta.db_table,
+                           )
+    return RTREE_SQL[count].format(rtree_table=tree.rtree_table())
+
+# params are the table and primary key column names, and the number of ids
+POSTGRES_NEXTVAL_SQL = '''
+                select nextval(pg_get_serial_sequence(%s, %s))
+                from generate_series(1, %s)
+                '''
+
+POSTGRES_RELTUPLES_SQL = '''
+                select reltuples
+                from pg_class
+                where oid = %s::regclass
+                '''
+
+POSTGRES_ANALYZE_SQL = 'analyze {table}'
+
+POSTGRES_ADD_COUNT_SQL = '''
+                update {table}
+                set item_count = item_count + %s
+                where id = %s
+                returning item_count
+                '''.format(table=Node._meta.db_table)
+
+POSTGRES_READ_COUNT_SQL = '''
+                select item_count
+                from {table}
+                where id = %s
+                for update
+                '''.format(table=Node._meta.db_table)
+
+POSTGRES_APPEND_PAYLOAD_SQL = '''
+                update {table}
+                set payload = coalesce(payload, ''::bytea) || %s, item_count = item_count + %s
+                where id = %s
+                returning item_count
+                '''.format(table=Node._meta.db_table)
+
+POSTGRES_INSERT_SQL = '''
+                insert into {table} ({columns})
+                select * from unnest({arrays})
+                '''
+
+ITEMS_MANY_EXTRACT = '''SELECT items.id AS id, items.item_id, items.x_min, items.ymin, items.x_max, items.ymax, traversal.qid AS query_index
+               FROM traversal
+               INNER JOIN {links_table} AS links ON links.node_id = traversal.nodeid
+               INNER JOIN {items_table} AS items ON items.id = links.item_id
+               INNER JOIN queries ON queries.qid = traversal.qid
+               WHERE {itemcheck}'''.format(itemcheck=QUERIES_BOUNDSCHECK.format(table='items'),
+                                           items_table=Item._meta.db_table,
+                                           links_table=ItemNodeLink._meta.db_table,
+                                           )
+
+UNIQUE_MANY_EXTRACT = '''SELECT items.id AS id, items.item_id, items.x_min, items.ymin, items.x_max, items.ymax, traversal.qid AS query_index
+               FROM traversal
+               INNER JOIN {links_table} AS links ON links.node_id = traversal.nodeid
+               INNER JOIN {items_table} AS items ON items.id = links.item_id
+               INNER JOIN queries ON queries.qid = traversal.qid
+               INNER JOIN {nodes_table} AS leaf ON leaf.id = traversal.nodeid
+               WHERE {itemcheck} AND {refcheck}'''.format(nodes_table=Node._meta.db_table,
+                                                          itemcheck=QUERIES_BOUNDSCHECK.format(table='items'),
+                                                          refcheck=REFCHECK.format(node='leaf', item='items', qx='queries.qxmin', qy='queries.qymin'),
+                                                          items_table=Item._meta.db_table,
+                                                          links_table=ItemNodeLink._meta.db_table,
+                                                          )
+
+PACKED_MANY_EXTRACT = '''SELECT traversal.qid, nodes.payload
+               FROM traversal
+               INNER JOIN {nodes_table} AS nodes ON nodes.id = traversal.nodeid
+               WHERE nodes.payload IS NOT NULL'''.format(nodes_table=Node._meta.db_table)
+
+def intersect_many_sql(count, packed=False, unique=False):
+    # the statement for intersecting count bboxes at once, cached per count
+    # a count of None takes the bboxes as four arrays of coordinates instead, see PostgresBackend
+    # packed trees get the payloads of the matching nodes instead of items
+    if packed:
+        extract = PACKED_MANY_EXTRACT
+    elif unique:
+        extract = UNIQUE_MANY_EXTRACT
+    else:
+        extract = ITEMS_MANY_EXTRACT
+    if (count, extract) not in INTERSECT_MANY_SQL:
+        if count is None:
+            # one array param per coordinate
+            values = '''SELECT CAST(ord - 1 AS integer), qxmin, qymin, qxmax, qymax
+                     FROM unnest(%s::double precision[], %s::double precision[], %s::double precision[], %s::double precision[])
+                     WITH ORDINALITY AS q (qxmin, qymin, qxmax, qymax, ord)'''
         else:
-            self.item_count += 1
+            values = 'VALUES ' + ', '.join('({}, %s, %s, %s, %s)'.format(qid) for qid in range(count))
+        INTERSECT_MANY_SQL[count, extract] = '''
+                WITH RECURSIVE queries (qid, qxmin, qymin, qxmax, qymax) AS
+                    ({values}),
+                traversal AS
+                  (SELECT queries.qid, nodes.id AS nodeid
+                   FROM {nodes_table} AS nodes, queries
+                   WHERE nodes.id = %s AND {nodecheck}
+
+                   UNION ALL
+
+                   SELECT traversal.qid, nodes.id AS nodeid
+                   FROM traversal
+                   INNER JOIN {nodes_table} AS nodes ON traversal.nodeid = nodes.parent_id
+                   INNER JOIN queries ON queries.qid = traversal.qid
+                   WHERE {nodecheck}
+                   )
+
+               -- Extract
+               {extract}
+                '''.format(values=values,
+                           extract=extract,
+                           nodecheck=QUERIES_BOUNDSCHECK.format(table='nodes'),
+                           nodes_table=Node._meta.db_table,
+                           )
+    return INTERSECT_MANY_SQL[count, extract]
+
+POINT_SQL = {}
+
+def point_sql(count, packed=False):
+    # the statement for the items of count nodes that contain a point, cached per count
+    # packed trees get the payloads of the nodes instead, to be filtered in python
+    if (count, packed) not in POINT_SQL:
+        nodeids = ', '.join(['%s'] * count)
+        if packed:
+            sql = '''
+                SELECT payload
+                FROM {nodes_table}
+                WHERE id IN ({nodeids}) AND payload IS NOT NULL
+                '''
+        else:
+            sql = '''
+                SELECT items.id, items.item_id, items.x_min, items.ymin, items.x_max, items.ymax
+                FROM {links_table} AS links
+                CROSS JOIN {items_table} AS items
+                WHERE links.node_id IN ({nodeids}) AND items.id = links.item_id
+                AND items.x_min <= %s AND items.x_max >= %s AND items.ymin <= %s AND items.ymax >= %s
+                '''
+        POINT_SQL[count, packed] = sql.format(nodeids=nodeids,
+                                              nodes_table=Node._meta.db_table,
+                                              items_table=Item._meta.db_table,
+                                              links_table=ItemNodeLink._meta.db_table,
+                                              )
+    return POINT_SQL[count, packed]
+
+NODE_ITEMS_SQL = {}
+
+def node_items_sql(count, packed=False):
+    # the statement for the items stored on count nodes, cached per count
+    # rows start with the node id, packed trees get the payloads of the nodes instead
+    # a count of None takes the node ids as one array, see PostgresBackend
+    if (count, packed) not in NODE_ITEMS_SQL:
+        if count is None:
+            nodeids = 'SELECT unnest(%s::{}[])'.format(Node._meta.pk.rel_db_type(connection))
+        else:
+            nodeids = ', '.join(['%s'] * count)
+        if packed:
+            sql = '''
+                SELECT id, payload
+                FROM {nodes_table}
+                WHERE id IN ({nodeids}) AND payload IS NOT NULL
+                '''
+        else:
+            sql = '''
+                SELECT links.node_id, items.id, items.item_id, items.x_min, items.ymin, items.x_max, items.ymax
+                FROM {links_table} AS links
+                CROSS JOIN {items_table} AS items
+                WHERE links.node_id IN ({nodeids}) AND items.id = links.item_id
+                '''
+        NODE_ITEMS_SQL[count, packed] = sql.format(nodeids=nodeids,
+                                                   nodes_table=Node._meta.db_table,
+                                                   items_table=Item._meta.db_table,
+                                                   links_table=ItemNodeLink._meta.db_table,
+                                                   )
+    return NODE_ITEMS_SQL[count, packed]
 
+LINEAR_INTERSECT_SQL = {}
 
+def linear_intersect_sql(rangecount, keycount, unique=False):
+    # the statement for a linear intersect with the given number of code ranges and single codes
+    # each range is its own subquery so that it becomes an index range scan on (index_id, code)
+    shape = (rangecount, keycount, unique)
+    if shape not in LINEAR_INTERSECT_SQL:
+        nodes_table = Node._meta.db_table
+        scans = ['SELECT id, item_count, x_min, ymin, x_max, ymax FROM {} WHERE index_id = %s AND code BETWEEN %s AND %s'.format(nodes_table)] * rangecount
+        if keycount:
+            scans.append('SELECT id, item_count, x_min, ymin, x_max, ymax FROM {} WHERE index_id = %s AND code IN ({})'.format(nodes_table, ', '.join(['%s'] * keycount)))
+        itemcheck = TABLE_BOUNDSCHECK.format(table='items')
+        if unique:
+            # the cells may cover leaves the query only touches, which REFCHECK assumes were pruned
+            itemcheck += ' AND ' + TABLE_BOUNDSCHECK.format(table='leaves')
+            itemcheck += ' AND ' + REFCHECK.format(node='leaves', item='items', qx='%s', qy='%s')
+        LINEAR_INTERSECT_SQL[shape] = '''
+                WITH leaves AS
+                    ({scans})
 
+               -- Extract
+               SELECT items.id AS id, items.item_id, items.x_min, items.ymin, items.x_max, items.ymax
+               FROM leaves
+               INNER JOIN {links_table} AS links ON links.node_id = leaves.id
+               INNER JOIN {items_table} AS items ON items.id = links.item_id
+               WHERE {itemcheck}
+                '''.format(scans='\n                     UNION ALL\n                     '.join(scans),
+                           itemcheck=itemcheck,
+                           items_table=Item._meta.db_table,
+                           links_table=ItemNodeLink._meta.db_table,
+                           )
+    return LINEAR_INTERSECT_SQL[shape]
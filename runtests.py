@@ -53,7 +53,7 @@ class QuickDjangoTest:
         if self.database == 'postgres':
             databases = {
                 'default': {
-                    'ENGINE': 'django.db.backends.postresql',
+                    'ENGINE': 'django.db.backends.postgresql',
                     'NAME': 'test_db',
                     'HOST': '127.0.0.1',
                     'USER': 'postgres',